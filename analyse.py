@@ -5,122 +5,710 @@ import pandas as pd
 import argparse
 import csv
 import string, math, os, random
+import itertools
+import hashlib, pickle
+import base64, json, time
+import contextlib, functools, threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 
-import plotly as py
-import plotly.graph_objs as go
-from plotly import tools
-from plotly.offline import download_plotlyjs, init_notebook_mode, plot, iplot
-
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-from mpl_toolkits.mplot3d import Axes3D
-
-import sklearn
-from sklearn import datasets, model_selection, metrics, neighbors, preprocessing
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.naive_bayes import GaussianNB
-from sklearn.svm import SVC
-from sklearn.model_selection import train_test_split, cross_val_score
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import normalize
+# plotly, matplotlib and sklearn are imported inside the functions that use them,
+# so a run only pays for the libraries of the stages it executes
 
 np.random.seed(123456789)
 
-def load_data(input_name):
-	'''Loading data from sklearn'''
+STAGES = ['stats', 'hist', 'box', 'corr', 'scatter', '3d', 'classify', 'sweep', 'hyper']
+DEFAULT_STAGES = ['stats', 'hist', 'box', 'corr', 'scatter', '3d', 'classify']
+DATASETS = ['boston', 'wine', 'iris', 'diabetes', 'breast_cancer']		# Datasets analysed by 'all'
+
+dataset_name = None			# Name of the dataset being analysed, used for the output folders
+dataset = None				# sklearn-style dataset (data, target, feature_names, target_names)
+classification_flag = None	# True if the dataset has classes to group by
+args = None					# Parsed command line
+arg_parser = None			# Parser of the command line, reports the errors found once a dataset is loaded
+num_PCA = 3 					# Set the number of culumns for PCA 
+
+def load_data(input_name, target_column='target'):
+	'''Loading data from sklearn or from a CSV/Parquet file'''
+	if os.path.isfile(input_name):
+		dataset = load_table(input_name, target_column)
+		classification_flag = len(dataset.target_names) > 0
+		print('Successfully loaded file ', input_name, ' (', dataset.data.shape[0], 'rows,', dataset.data.shape[1], 'features )')
+		return(dataset, classification_flag)
+
+	import sklearn.datasets
 	names = [name for name in dir(sklearn.datasets) if name.startswith("load")]
 	assert "load_{0}".format(input_name) in names, 'Invalid dataset name: ' + input_name + '\nPossible names: \nboston \nwine \niris \ndiabetes \nbreast_cancer'
 	
-	for i in names:
-		if input_name == 'boston':
-			from sklearn.datasets import load_boston
-			dataset = load_boston()
-			classification_flag = False			# For future grouping purposes
-		elif input_name == 'wine':
-			from sklearn.datasets import load_wine
-			dataset = load_wine()		
-			classification_flag = True	
-		elif input_name == 'iris':
-			from sklearn.datasets import load_iris
-			dataset = load_iris()
-			classification_flag = True
-		elif input_name == 'diabetes':
-			from sklearn.datasets import load_diabetes
-			dataset = load_diabetes()
-			classification_flag = False		
-		elif input_name == 'breast_cancer':
-			from sklearn.datasets import load_breast_cancer
-			dataset = load_breast_cancer()
-			classification_flag = True	
+	if input_name == 'boston':
+		from sklearn.datasets import load_boston
+		dataset = load_boston()
+		classification_flag = False			# For future grouping purposes
+	elif input_name == 'wine':
+		from sklearn.datasets import load_wine
+		dataset = load_wine()		
+		classification_flag = True	
+	elif input_name == 'iris':
+		from sklearn.datasets import load_iris
+		dataset = load_iris()
+		classification_flag = True
+	elif input_name == 'diabetes':
+		from sklearn.datasets import load_diabetes
+		dataset = load_diabetes()
+		classification_flag = False		
+	elif input_name == 'breast_cancer':
+		from sklearn.datasets import load_breast_cancer
+		dataset = load_breast_cancer()
+		classification_flag = True	
 	print('Successfully loaded dataset ', input_name)
 	return(dataset, classification_flag)
 
+
+TABLE_CHUNK_ROWS = 100000		# Rows read from a CSV/Parquet file at a time
+MISSING_POLICY = 'skip non-numeric columns, drop rows with a missing or non-numeric feature value'
+
+def numeric_columns(chunk, columns):
+	'''Columns of the chunk holding numbers: most of their non-empty cells parse as numbers
+
+	Text columns (ids, dates, names) would be missing in every row and are left out instead.
+	'''
+	numeric = []
+	for c in columns:
+		present = int(chunk[c].notna().sum())
+		parsed = int(np.isfinite(pd.to_numeric(chunk[c], errors='coerce').astype(np.float64)).sum())
+		if parsed and 2 * parsed >= present:
+			numeric.append(c)
+	return numeric
+
+
+def iter_table_chunks(path, chunk_rows):
+	'''Reading a CSV or Parquet file as a stream of DataFrame chunks'''
+	if path.endswith('.parquet') or path.endswith('.pq'):
+		try:
+			import pyarrow.parquet as pq
+		except ImportError:
+			raise ImportError('Reading Parquet files requires pyarrow: pip install pyarrow')
+		for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+			yield batch.to_pandas()
+	else:
+		for chunk in pd.read_csv(path, chunksize=chunk_rows):
+			yield chunk
+
+
+def load_table(path, target_column='target', chunk_rows=TABLE_CHUNK_ROWS):
+	'''Streaming a CSV/Parquet file into memory-mapped float32 .npy files cached next to it
+
+	The result has the same data, feature_names, target and target_names fields as the sklearn datasets.
+	Target values are treated as class labels (missing labels are stored as -1);
+	without a target column the dataset is not grouped. The feature columns are the numeric columns
+	of the first chunk; the others are skipped. Rows with a missing or non-numeric feature value
+	are dropped while reading. Skipped columns and dropped rows are printed and recorded in meta.json.
+	'''
+	cache = path + '.npcache'
+	meta_path = os.path.join(cache, 'meta.json')
+	st = os.stat(path)
+	source = dict(size=st.st_size, mtime=st.st_mtime, target=target_column, missing=MISSING_POLICY)
+
+	if os.path.exists(meta_path):
+		with open(meta_path) as f:
+			meta = json.load(f)
+		if meta['source'] == source:
+			print('Using cached copy of ', path)
+			if meta['missing']['skipped_columns']:
+				print('Skipped non-numeric columns: ' + ', '.join(meta['missing']['skipped_columns']))
+			if meta['missing']['rows_dropped']:
+				print('Dropped {0} of {1} rows with a missing or non-numeric feature value'.format(meta['missing']['rows_dropped'], meta['missing']['rows_read']))
+			return open_table_cache(cache, meta)
+
+	if not os.path.exists(cache):
+		os.makedirs(cache)
+	data_raw = os.path.join(cache, 'data.raw')
+	target_raw = os.path.join(cache, 'target.raw')
+	feature_names = None
+	skipped = []			# non-numeric columns left out of the features
+	labels = dict()			# label -> code in order of appearance
+	n_rows = 0
+	n_read = 0
+	missing = None			# missing or non-numeric cells per feature
+	with open(data_raw, 'wb') as fd, open(target_raw, 'wb') as ft:
+		for chunk in iter_table_chunks(path, chunk_rows):
+			if feature_names is None:
+				columns = [c for c in chunk.columns if c != target_column]
+				feature_names = numeric_columns(chunk, columns)
+				skipped = [str(c) for c in columns if c not in feature_names]
+				if skipped:
+					print('Skipped non-numeric columns: ' + ', '.join(skipped))
+				missing = np.zeros(len(feature_names), dtype=np.int64)
+			X = chunk[feature_names].apply(pd.to_numeric, errors='coerce', downcast='float')
+			X = np.ascontiguousarray(X.values, dtype=np.float32)
+			bad = ~np.isfinite(X)
+			missing += bad.sum(axis=0)
+			complete = ~bad.any(axis=1)
+			fd.write(X[complete].tobytes())
+			if target_column in chunk.columns:
+				local, uniques = pd.factorize(chunk[target_column])
+				codes = np.array([labels.setdefault(u, len(labels)) for u in uniques] + [-1], dtype=np.int32)
+				ft.write(codes[local][complete].tobytes())		# missing labels (-1) pick the trailing -1
+			n_read += len(chunk)
+			n_rows += int(complete.sum())
+	if n_rows < n_read:
+		print('Dropped {0} of {1} rows with a missing or non-numeric feature value'.format(n_read - n_rows, n_read))
+	if not feature_names:
+		raise ValueError('No numeric feature columns in ' + path)
+	if n_rows == 0:
+		raise ValueError('No complete rows in ' + path)
+
+	# Sorting the labels like sklearn does (numerically if they are all numbers) and storing the codes in the smallest integer type
+	try:
+		target_names = sorted(labels, key=float)
+	except (TypeError, ValueError):
+		target_names = sorted(labels, key=str)
+	remap = np.empty(len(labels) + 1, dtype=np.int32)
+	remap[[labels[name] for name in target_names]] = np.arange(len(target_names))
+	remap[-1] = -1
+	code_type = np.min_scalar_type(-max(len(target_names), 1))
+
+	raw = np.memmap(data_raw, dtype=np.float32, mode='r', shape=(n_rows, len(feature_names)))
+	data = np.lib.format.open_memmap(os.path.join(cache, 'data.npy'), mode='w+', dtype=np.float32, shape=raw.shape)
+	target = np.lib.format.open_memmap(os.path.join(cache, 'target.npy'), mode='w+', dtype=code_type, shape=(n_rows,))
+	raw_target = np.memmap(target_raw, dtype=np.int32, mode='r', shape=(n_rows,)) if labels else None
+	for i in range(0, n_rows, chunk_rows):
+		data[i:i+chunk_rows] = raw[i:i+chunk_rows]
+		target[i:i+chunk_rows] = remap[raw_target[i:i+chunk_rows]] if labels else 0
+	data.flush()
+	target.flush()
+	del raw, raw_target
+	os.remove(data_raw)
+	os.remove(target_raw)
+
+	feature_names = [str(c) for c in feature_names]
+	meta = dict(source=source, feature_names=feature_names, target_names=[str(name) for name in target_names],
+		missing=dict(policy=MISSING_POLICY, skipped_columns=skipped, rows_read=n_read, rows_dropped=n_read - n_rows,
+			cells={name: int(n) for name, n in zip(feature_names, missing) if n}))
+	with open(meta_path, 'w') as f:
+		json.dump(meta, f)
+	return open_table_cache(cache, meta)
+
+
+def open_table_cache(cache, meta):
+	'''Memory-mapping the cached .npy files as a sklearn-style dataset'''
+	from sklearn.utils import Bunch
+	return Bunch(
+		data = np.load(os.path.join(cache, 'data.npy'), mmap_mode='r'),
+		target = np.load(os.path.join(cache, 'target.npy'), mmap_mode='r'),
+		feature_names = np.array(meta['feature_names']),
+		target_names = np.array(meta['target_names'])
+	)
+
 	
-def parser_assign():
+def parser_assign(argv=None):
 	'''Setting up parser for the file name and header file name '''
+	global arg_parser
 	parser = argparse.ArgumentParser()
-	parser.add_argument("dataset_name")   # name of the file specified in Dockerfile
-	args = parser.parse_args()
-	d_name = args.dataset_name
-	return d_name
+	arg_parser = parser
+	parser.add_argument("datasets", nargs='+', metavar="dataset_name", help="dataset names or paths to CSV/Parquet files, 'all' for every built-in dataset")   # name of the file specified in Dockerfile
+	parser.add_argument("--batch-workers", type=int, default=None, help="datasets analysed at the same time when several are given (default: one per dataset, at most one per core)")
+	parser.add_argument("--target", default='target', help="name of the class column when loading a CSV/Parquet file")
+	parser.add_argument("--sweep", action="store_true", help="cross-validate every 2- and 3-feature combination and write a ranked table")
+	parser.add_argument("--jobs", type=int, default=None, help="number of worker processes for cross-validation (default: all cores)")
+	parser.add_argument("--cache-dir", default='.analyse_cache', help="folder of the persistent fold/fit cache")
+	parser.add_argument("--cache-size", type=int, default=512, help="cache size limit in MB, least recently used entries are evicted")
+	parser.add_argument("--no-cache", action="store_true", help="always refit every model")
+	parser.add_argument("--plot-workers", type=int, default=1, help="number of worker processes rendering the scatter plots")
+	parser.add_argument("--features", nargs='+', default=None, help="2 or 3 feature names for the 2-D classification instead of the built-in choice")
+	parser.add_argument("--pca", type=int, nargs='?', const=num_PCA, default=0, metavar="N", help="classify the first N principal components instead of the chosen features (N = {0} if omitted)".format(num_PCA))
+	parser.add_argument("--pca-solver", choices=PCA_SOLVERS, default='full', help="exact SVD, randomized SVD, or chunked IncrementalPCA for data larger than memory")
+	parser.add_argument("--knn-backend", choices=KNN_BACKENDS, default='auto', help="neighbour search of the KNN models: sklearn's choice, brute force, KD-tree, ball tree or the approximate LSH index")
+	parser.add_argument("--tune", action="store_true", help="search the tuned model parameters with successive halving before classifying")
+	parser.add_argument("--force", action="store_true", help="rerun the selected stages even if their outputs are up to date")
+	parser.add_argument("--density-rows", type=int, default=density_rows, metavar="N", help="draw the scatter plots of datasets with more than N rows as per-class density rasters (default: %(default)s)")
+	parser.add_argument("--corr-cluster", action="store_true", help="order the correlation heatmap by hierarchical clustering of the features (needs scipy)")
+	parser.add_argument("--trace", default=None, metavar="FILE", help="write a Chrome/Perfetto trace of the stages, plots and CV jobs to FILE and print a summary")
+	parser.add_argument("--stages", default=','.join(DEFAULT_STAGES), help="comma-separated stages to run out of: " + ', '.join(STAGES) + " (or 'all')")
+	args = parser.parse_args(argv)
+	stages = STAGES if args.stages == 'all' else [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+	for stage in stages:
+		if stage not in STAGES:
+			parser.error('Invalid stage: ' + stage + '\nPossible stages: ' + ', '.join(STAGES))
+	if args.sweep and 'sweep' not in stages:
+		stages.append('sweep')
+	args.stages = stages
+	if 'all' in args.datasets:
+		args.datasets = DATASETS
+	if args.features is not None and (not 2 <= len(args.features) <= 3 or len(set(args.features)) < len(args.features)):
+		parser.error('--features takes 2 or 3 different feature names, got: ' + ', '.join(args.features))
+	return args
+
+
+trace_events = None		# Chrome trace events of the run, collected only with --trace
+trace_start = 0
+
+def bytes_written():
+	'''Bytes this process has passed to write() so far (Linux /proc/self/io, 0 elsewhere)'''
+	try:
+		with open('/proc/self/io') as f:
+			for line in f:
+				if line.startswith('wchar:'):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return 0
 
 
-def read_data(df, feature_n, tar):
-	'''Copying data from dataset to Data Frame'''
-	data = pd.DataFrame(data = df)
-	data.columns = feature_n			# assigning feature names to the names of the columns
+def peak_rss():
+	'''Peak resident set size of this process in bytes (0 where the resource module is missing)'''
 	try:
-		data['target'] = pd.Categorical(pd.Series(tar).map(lambda x: dataset.target_names[x]))
-	except:
-		data['target'] = tar
-	
+		import resource
+	except ImportError:
+		return 0
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024		# kilobytes on Linux
+
+
+@contextlib.contextmanager
+def traced(name, category, **info):
+	'''Recording the wall time, CPU time, peak RSS and bytes written of a block as one trace event'''
+	if trace_events is None:
+		yield info
+		return
+	wall, cpu, rss, written = time.time(), time.process_time(), peak_rss(), bytes_written()
+	try:
+		yield info			# the block can add its own fields to the event
+	finally:
+		info.update(
+			cpu_ms = round((time.process_time() - cpu) * 1e3, 3),
+			peak_rss_mb = round(peak_rss() / 2**20, 1),
+			rss_growth_mb = round((peak_rss() - rss) / 2**20, 1),
+			written_bytes = bytes_written() - written
+		)
+		trace_events.append(dict(name=name, cat=category, ph='X', ts=round(wall * 1e6), dur=round((time.time() - wall) * 1e6),
+			pid=os.getpid(), tid=threading.get_ident(), args=info))
+
+
+def trace_function(func, category='plot'):
+	'''Wrapping a function so every call is traced under its name, with its arguments'''
+	@functools.wraps(func)
+	def wrapper(*a, **kw):
+		with traced(func.__name__, category, arguments=' | '.join(str(v) for v in a)):
+			return func(*a, **kw)
+	return wrapper
+
+
+def collect_trace(func, arg):
+	'''Worker: running func(arg) and sending the trace events it recorded back with the result'''
+	del trace_events[:]			# the forked list still holds the events of the parent
+	result = func(arg)
+	return result, list(trace_events)
+
+
+def traced_results(results):
+	'''Parent: merging the trace events of the workers and yielding their results'''
+	for result, events in results:
+		trace_events.extend(events)
+		yield result
+
+
+def start_trace():
+	'''Starting to collect trace events'''
+	global trace_events, trace_start
+	trace_events = []
+	trace_start = time.time()
+
+
+def write_trace(filename, top=20):
+	'''Writing the Chrome trace (chrome://tracing, ui.perfetto.dev) and printing a summary table'''
+	main_pid = os.getpid()
+	events = list(trace_events)
+	for pid in sorted(set(e['pid'] for e in events)):
+		events.append(dict(name='process_name', ph='M', pid=pid, tid=0, args=dict(name='analyse' if pid == main_pid else 'worker {0}'.format(pid))))
+	with open(filename, 'w') as f:
+		json.dump(dict(traceEvents=events, displayTimeUnit='ms', otherData=dict(dataset=dataset_name, started=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(trace_start)))), f)
+
+	# Totals per (category, name): stages are nested around plots and CV jobs, so columns overlap between categories
+	totals = dict()
+	for e in trace_events:
+		t = totals.setdefault((e['cat'], e['name']), [0, 0.0, 0.0, 0.0, 0])
+		t[0] += 1
+		t[1] += e['dur'] / 1e6
+		t[2] += e['args']['cpu_ms'] / 1e3
+		t[3] = max(t[3], e['args']['peak_rss_mb'])
+		t[4] += e['args']['written_bytes']
+	rows = sorted(totals.items(), key=lambda item: -item[1][1])
+	print('\n Trace written to {0} ({1} events), slowest entries:'.format(filename, len(trace_events)))
+	print(' {0:<8} {1:<40} {2:>6} {3:>9} {4:>9} {5:>9} {6:>10}'.format('category', 'name', 'calls', 'wall s', 'cpu s', 'rss MB', 'written MB'))
+	for (category, name), (calls, wall, cpu, rss, written) in rows[:top]:
+		print(' {0:<8} {1:<40} {2:>6} {3:9.3f} {4:9.3f} {5:9.1f} {6:10.2f}'.format(category, name[:40], calls, wall, cpu, rss, written / 2**20))
+
+
+class ClassFrames(object):
+	'''Rows of each class as views of the data frame, created on access (the rows are sorted by class)'''
+	def __init__(self, frame, bounds):
+		self.frame = frame
+		self.bounds = bounds
+
+	def __len__(self):
+		return len(self.bounds) - 1
+
+	def __getitem__(self, i):
+		if not -len(self) <= i < len(self):
+			raise IndexError(i)
+		i %= len(self)
+		return self.frame.iloc[self.bounds[i]:self.bounds[i+1]]
+
+
+def read_data(df, feature_n, tar):
+	'''Wrapping the data in a Data Frame over a single float32 array
+
+	For classification the rows are sorted by class, so grouped["data"] holds per-class views
+	instead of copies.
+	'''
+	values = np.asarray(df)
+	columns = list(feature_n)
 	if dataset_name == 'breast_cancer':		# if this is breast cancer dataset we choose only mean values for visalisation (10 out of 30 features)
-		data1 = data.iloc[:,:10]
-		data1['target'] = data['target']
-	else: data1 = data
+		values = values[:, :10]
+		columns = columns[:10]
 
 	grouped = dict()						# Defining a dictionary of grouped elements for future usage
+	target = None
+	if classification_flag == True:
+		tar = np.asarray(tar)
+		labels = list(dataset.target_names)
+		if np.issubdtype(tar.dtype, np.integer):
+			codes = tar.astype(np.intp)		# missing labels (-1) belong to no class
+		else:
+			codes = pd.Categorical(tar, categories=labels).codes.astype(np.intp)
+		order = np.argsort(codes, kind='stable')
+		codes = codes[order]
+		sorted_values = np.empty(values.shape, dtype=np.float32)		# the only copy of the data, filled in chunks
+		for i in range(0, len(order), STATS_CHUNK_ROWS):
+			sorted_values[i:i+STATS_CHUNK_ROWS] = values[order[i:i+STATS_CHUNK_ROWS]]
+		values = sorted_values
+		bounds = np.searchsorted(codes, np.arange(len(labels) + 1))
+		target = pd.Categorical.from_codes(codes, categories=labels)
+		grouped["labels"] = labels
+	else:
+		values = np.asarray(values, dtype=np.float32)
+
+	data = pd.DataFrame(values, columns=columns, copy=False)
 	if classification_flag == True:
-		d = []
-		l = []
-		for i, name in enumerate(dataset.target_names):
-			d.append(data1.loc[data1['target']==name])
-			l.append(name)
-		grouped["data"] = d
-		grouped["labels"] = l
-	return data1, grouped
+		data['target'] = target
+		grouped["data"] = ClassFrames(data, bounds)
+	else:
+		data['target'] = tar
+	return data, grouped
+
+
+PLOTLY_TYPES = dict(float32='Float32Array', float64='Float64Array', int8='Int8Array', uint8='Uint8Array', int16='Int16Array', uint16='Uint16Array', int32='Int32Array', uint32='Uint32Array')
+
+REPORT_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<div id="plot"></div>
+<script type="text/javascript">{plotlyjs}</script>
+<script type="text/javascript">
+var TYPES = {types};
+function decode(v) {{
+	if (Array.isArray(v)) return v.map(decode);
+	if (v !== null && typeof v === 'object') {{
+		if ('bdata' in v && 'dtype' in v) {{
+			var bin = atob(v.bdata), bytes = new Uint8Array(bin.length);
+			for (var i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+			return new window[TYPES[v.dtype]](bytes.buffer);
+		}}
+		var out = {{}};
+		for (var k in v) out[k] = decode(v[k]);
+		return out;
+	}}
+	return v;
+}}
+Plotly.newPlot('plot', decode({data}), decode({layout}));
+</script>
+</body>
+</html>
+'''
+
+def typed_array(values, dtype='float32'):
+	'''Encoding an array as base64 bytes, decoded into a JavaScript typed array in the report'''
+	a = np.ascontiguousarray(values, dtype=dtype)
+	return dict(dtype=a.dtype.name, bdata=base64.b64encode(a.tobytes()).decode('ascii'))
+
+
+def write_plotly_report(filename, title, data, layout):
+	'''Writing one self-contained HTML file that embeds plotly.js a single time'''
+	from plotly.offline import get_plotlyjs
+	with open(filename, 'w') as f:
+		f.write(REPORT_TEMPLATE.format(title=title, plotlyjs=get_plotlyjs(), types=json.dumps(PLOTLY_TYPES), data=json.dumps(data), layout=json.dumps(layout)))
+
+
+STATS_CHUNK_ROWS = 65536		# Rows folded into the statistics at a time
+STATS_CHUNK_CELLS = 1 << 22		# Upper bound on rows*features of a chunk, so wide data is processed in smaller blocks
+DENSITY_BINS = 300				# Raster cells per axis of the scatter plots drawn as densities
+DENSITY_BINS_3D = 32			# Voxels per axis of the 3-D scatter plots drawn as densities
+density_rows = 100000			# Scatter plots of datasets with more rows are drawn as per-class density rasters
+
+class StreamingStats(object):
+	'''One-pass mean, variance, min/max and co-moment matrix that can be merged across chunks and workers
+
+	Missing values (NaN) are skipped like in the histograms: every feature has its own count, and every
+	pair of features its own count, means and co-moments over the rows where both are present.
+	Entry [i, j] of the pair matrices describes feature i on the rows where feature j is present too.
+	'''
+	def __init__(self, n_features):
+		self.counts = np.zeros((n_features, n_features))
+		self.means = np.zeros((n_features, n_features))
+		self.comoment = np.zeros((n_features, n_features))		# sum of products of deviations from the pair means
+		self.squares = np.zeros((n_features, n_features))		# sum of squared deviations of feature i from its pair mean
+		self.min = np.full(n_features, np.inf)
+		self.max = np.full(n_features, -np.inf)
+
+	@property
+	def n(self):
+		return np.diag(self.counts)
+
+	@property
+	def mean(self):
+		return np.diag(self.means).copy()
+
+	def update(self, X):
+		'''Folding a chunk of rows into the statistics'''
+		X = np.asarray(X, dtype=np.float64)
+		if len(X) == 0:
+			return self
+		present = ~np.isnan(X)
+		W = present.astype(np.float64)
+		chunk = StreamingStats(X.shape[1])
+		chunk.counts = W.T @ W
+		with np.errstate(invalid='ignore', divide='ignore'):
+			shift = np.where(present.any(axis=0), np.nanmean(np.where(present, X, np.nan), axis=0), 0)
+			D = np.where(present, X - shift, 0)			# deviations from the chunk mean, 0 where missing
+			pair_means = (D.T @ W) / chunk.counts
+		pair_means[chunk.counts == 0] = 0
+		chunk.means = pair_means + shift[:, None]
+		chunk.comoment = D.T @ D - chunk.counts * pair_means * pair_means.T
+		chunk.squares = (D**2).T @ W - chunk.counts * pair_means**2
+		chunk.min = np.where(present, X, np.inf).min(axis=0)
+		chunk.max = np.where(present, X, -np.inf).max(axis=0)
+		return self.merge(chunk)
+
+	def merge(self, other):
+		'''Combining with statistics of another part of the data (Chan et al. pairwise update, per pair of features)'''
+		n = self.counts + other.counts
+		with np.errstate(invalid='ignore', divide='ignore'):
+			weight = np.where(n > 0, self.counts * other.counts / n, 0)
+			share = np.where(n > 0, other.counts / n, 0)
+		delta = other.means - self.means
+		self.comoment += other.comoment + delta * delta.T * weight
+		self.squares += other.squares + delta**2 * weight
+		self.means += delta * share
+		self.counts = n
+		self.min = np.minimum(self.min, other.min)
+		self.max = np.maximum(self.max, other.max)
+		return self
+
+	def variance(self, ddof=0):
+		return np.diag(self.comoment) / np.maximum(self.n - ddof, 1)
+
+	def covariance(self, ddof=1):
+		return self.comoment / np.maximum(self.counts - ddof, 1)
+
+	def correlation(self):
+		'''Pearson coefficients over the rows where both features are present'''
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return self.comoment / np.sqrt(self.squares * self.squares.T)
+
+
+def accumulate_stats(X, labels=None, n_classes=0, chunk_rows=STATS_CHUNK_ROWS):
+	'''Overall and per-class statistics of X in one pass over row chunks'''
+	overall = StreamingStats(X.shape[1])
+	per_class = [StreamingStats(X.shape[1]) for _ in range(n_classes)]
+	chunk_rows = max(1, min(chunk_rows, STATS_CHUNK_CELLS // max(X.shape[1], 1)))
+	for i in range(0, len(X), chunk_rows):
+		chunk = np.asarray(X[i:i+chunk_rows], dtype=np.float64)
+		overall.update(chunk)
+		if n_classes:
+			codes = labels[i:i+chunk_rows]
+			for c in range(n_classes):
+				per_class[c].update(chunk[codes == c])
+	return overall, per_class
+
+
+def bin_histograms(X, mins, maxs, labels=None, n_classes=0, bins=10, chunk_rows=STATS_CHUNK_ROWS):
+	'''Shared bin edges and per-class counts of every feature in one vectorized pass over row chunks
+
+	Returns edges (features x bins+1) and counts (classes x features x bins), one "class" without labels.
+	'''
+	n_features = X.shape[1]
+	mins = np.asarray(mins, dtype=np.float64)
+	width = np.where(maxs > mins, (np.asarray(maxs) - mins) / bins, 1.0)
+	edges = mins[:, None] + width[:, None] * np.arange(bins + 1)
+	groups = max(n_classes, 1)
+	counts = np.zeros(groups * n_features * bins, dtype=np.int64)
+	offsets = np.arange(n_features) * bins
+	chunk_rows = max(1, min(chunk_rows, STATS_CHUNK_CELLS // max(n_features, 1)))
+	for i in range(0, len(X), chunk_rows):
+		chunk = np.asarray(X[i:i+chunk_rows], dtype=np.float64)
+		valid = ~np.isnan(chunk)
+		with np.errstate(invalid='ignore'):
+			b = np.floor((chunk - mins) / width).astype(np.int64)
+		np.clip(b, 0, bins - 1, out=b)			# the maximum falls into the last bin, like numpy/pandas
+		idx = b + offsets
+		if n_classes:
+			codes = np.asarray(labels[i:i+chunk_rows], dtype=np.int64)
+			idx += (codes * n_features * bins)[:, None]
+			valid &= (codes >= 0)[:, None]
+		counts += np.bincount(idx[valid], minlength=counts.size)
+	return edges, counts.reshape(groups, n_features, bins)
+
+
+CLUSTER_POINTS = 5000			# Markers of a 3-D clustering report, shared by the classes in proportion to their size
+
+def stratified_sample(bounds, budget, seed=0):
+	'''Sorted positions of a random sample of every class (rows bounds[i]:bounds[i+1]), about budget rows in total'''
+	rng = np.random.RandomState(seed)
+	sizes = np.diff(bounds)
+	total = max(sizes.sum(), 1)
+	samples = []
+	for n in sizes:
+		m = min(n, int(math.ceil(budget * n / total)))			# every non-empty class keeps at least one point
+		samples.append(np.sort(rng.choice(n, m, replace=False)) if m < n else np.arange(n))
+	return samples
+
+
+def convex_hull(points):
+	'''Vertices and triangular faces (indices into the vertices) of the convex hull, None without scipy or for flat data'''
+	try:
+		from scipy.spatial import ConvexHull, QhullError
+	except ImportError:
+		return None
+	points = np.asarray(points, dtype=np.float64)
+	points = points[np.isfinite(points).all(axis=1)]
+	try:
+		hull = ConvexHull(points)
+	except (QhullError, ValueError):
+		return None
+	remap = np.empty(len(points), dtype=np.int64)
+	remap[hull.vertices] = np.arange(len(hull.vertices))
+	return points[hull.vertices], remap[hull.simplices]
+
+
+def density_grid(columns, limits, labels=None, n_classes=0, bins=DENSITY_BINS, chunk_rows=STATS_CHUNK_ROWS):
+	'''Per-class counts of the points (columns[0][i], columns[1][i], ...) on a regular grid over limits
+
+	The histogram2d/histogramdd of every class in one vectorized pass over row chunks.
+	Returns counts of shape (classes, bins, ..., bins) indexed by the cell along each column, one "class" without labels.
+	'''
+	groups = max(n_classes, 1)
+	dims = len(columns)
+	counts = np.zeros(groups * bins**dims, dtype=np.int64)
+	for i in range(0, len(columns[0]), chunk_rows):
+		idx = np.zeros(len(columns[0][i:i+chunk_rows]), dtype=np.int64)
+		valid = np.ones(len(idx), dtype=bool)
+		if n_classes:
+			idx += np.asarray(labels[i:i+chunk_rows], dtype=np.int64)
+			valid &= idx >= 0
+		for values, (lo, hi) in zip(columns, limits):
+			chunk = np.asarray(values[i:i+chunk_rows], dtype=np.float64)
+			valid &= ~np.isnan(chunk)
+			with np.errstate(invalid='ignore'):
+				b = np.floor((chunk - lo) * (bins / (hi - lo) if hi > lo else 1.0)).astype(np.int64)
+			np.clip(b, 0, bins - 1, out=b)
+			idx = idx * bins + b
+		counts += np.bincount(idx[valid], minlength=counts.size)
+	return counts.reshape((groups,) + (bins,) * dims)
+
+
+def density_rgba(counts, color, alpha=1.0):
+	'''Image of one class in its colour, opaque where the class is densest and transparent where it is absent'''
+	from matplotlib.colors import to_rgb
+	rgba = np.zeros(counts.shape + (4,), dtype=np.float32)
+	rgba[..., :3] = to_rgb(color)
+	rgba[..., 3] = alpha * np.log1p(counts) / np.log1p(max(counts.max(initial=0), 1))
+	return rgba
+
+
+CORR_ANNOTATE_ALL = 20			# Heatmaps of up to this many features show every coefficient
+CORR_ANNOTATE_THRESHOLD = 0.9	# Above it only coefficients with |r| >= threshold are shown...
+CORR_ANNOTATE_LIMIT = 400		# ...the strongest ones, at most this many
+CORR_LABELS_MAX = 100			# Feature names are shown up to this many features
+
+def cluster_order(cor):
+	'''Order of the features that puts strongly correlated ones next to each other (needs scipy)'''
+	try:
+		from scipy.cluster import hierarchy
+		from scipy.spatial.distance import squareform
+	except ImportError:
+		print('\n scipy is not installed, keeping the original feature order')
+		return np.arange(len(cor))
+	dist = 1 - np.abs(np.nan_to_num(cor))
+	dist = np.clip((dist + dist.T) / 2, 0, None)
+	np.fill_diagonal(dist, 0)
+	return hierarchy.leaves_list(hierarchy.linkage(squareform(dist, checks=False), method='average'))
 
 
+SCATTER_MARGINS = dict(left=0.13, bottom=0.11, right=0.97, top=0.97)
+
 def all_functions(c_flag, df, gr):			#Closure that takes classification_flag, dataframe and grouped dictionary as an input
+	stats = dict()			# One pass of statistics shared by the summary and the correlation heatmap
+
+	def feature_stats():
+		'''Accumulating overall and per-class statistics of the feature columns on first use'''
+		if not stats:
+			names = [col for col in df.columns if col != 'target' or c_flag != True]
+			codes = None
+			if c_flag == True:
+				codes = pd.Categorical(df['target'], categories=gr["labels"]).codes
+				stats['all'], stats['classes'] = accumulate_stats(df[names].values, codes, len(gr["labels"]))
+			else:
+				stats['all'], stats['classes'] = accumulate_stats(df[names].values)
+			stats['names'] = names
+			stats['codes'] = codes
+		return stats
+
+	def histogram_counts():
+		'''Bin edges and per-class counts of all the features, computed once for both histogram figures'''
+		st = feature_stats()
+		if 'hist' not in st:
+			n_classes = len(gr["labels"]) if c_flag == True else 0
+			st['hist'] = bin_histograms(df[st['names']].values, st['all'].min, st['all'].max, st['codes'], n_classes, bins=10)
+		return st['names'], st['hist'][0], st['hist'][1]
+
+	def draw_histogram(ax, edges, counts, **kwargs):
+		'''Drawing precomputed counts as a bar histogram'''
+		ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', **kwargs)
+		ax.grid(True)
+
 	def find_mean_std():
 		'''Calculating mean and std for each of 30 features'''
-		ave_feature = np.mean(df) 		
-		std_feature = np.std(df) 
+		st = feature_stats()
+		ave_feature = pd.Series(st['all'].mean, index=st['names'])
+		std_feature = pd.Series(np.sqrt(st['all'].variance()), index=st['names'])
 
 		print('\n ave of each measurment:\n', ave_feature)
 		print('\n std of each measurment:\n', std_feature)
+		if c_flag == True:
+			print('\n ave of each measurment by class:\n', pd.DataFrame([c.mean for c in st['classes']], index=gr["labels"], columns=st['names']).T)
+			print('\n std of each measurment by class:\n', pd.DataFrame([np.sqrt(c.variance()) for c in st['classes']], index=gr["labels"], columns=st['names']).T)
+		print('\n min and max of each measurment:\n', pd.DataFrame(dict(min=st['all'].min, max=st['all'].max), index=st['names']))
 
 	
 	def plot_histograms():
 		'''Histogram all in one figure'''
+		import matplotlib.pyplot as plt
 		folder = "hist_{0}".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
-		columns = df.columns
-		l = len(columns)
+		names, edges, counts = histogram_counts()
+		counts = counts.sum(axis=0)				# all the classes together
+		l = len(names)
 		n_cols = math.ceil(math.sqrt(l))		#Calculating scaling for any number of features
 		n_rows = math.ceil(l / n_cols)
 		
 		fig=plt.figure(figsize=(11, 6), dpi=100)
-		for i, col_name in enumerate(columns):
-			if (classification_flag == False):
-				ax=fig.add_subplot(n_rows,n_cols,i+1)
-				df[col_name].hist(bins=10,ax=ax)
-				ax.set_title(col_name)
-			elif col_name != 'target':
-				ax=fig.add_subplot(n_rows,n_cols,i+1)
-				df[col_name].hist(bins=10,ax=ax)
-				ax.set_title(col_name)
+		for i, col_name in enumerate(names):
+			ax=fig.add_subplot(n_rows,n_cols,i+1)
+			draw_histogram(ax, edges[i], counts[i])
+			ax.set_title(col_name)
 		fig.tight_layout() 
 		plt.savefig("./{0}/all_hist.png".format(folder), bbox_inches='tight')
 		plt.show()
@@ -128,127 +716,200 @@ def all_functions(c_flag, df, gr):			#Closure that takes classification_flag, da
 
 	def plot_histograms_grouped():
 		"""Histogram: all features in one figure grouped by one element"""
+		import matplotlib.pyplot as plt
 		folder = "hist_{0}".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
-		columns = df.columns
-		l = len(df.columns)-1
+		names, edges, counts = histogram_counts()
+		l = len(names)
 		n_cols = math.ceil(math.sqrt(l))		# Calculating scaling for any number of features
 		n_rows = math.ceil(l / n_cols)
 		
 		fig=plt.figure(figsize=(11, 6), dpi=100)
 		
-		idx = 0
-		for i, col_name in enumerate(df.columns):		# Going through all the features
-			idx = idx+1
-			if col_name != 'target':				# Avoiding a histogram of the grouping element
-				ax=fig.add_subplot(n_rows,n_cols,idx)
-				ax.set_title(col_name)
-				group = df.pivot(columns='target', values=col_name)
-				for j, gr_feature_name in enumerate(group.columns):			# Going through the values of grouping feature (here malignant and benign)
-					group[gr_feature_name].hist(alpha=0.5, label=gr_feature_name)
-				plt.legend(loc='upper right')
-			else: idx = idx-1
+		for i, col_name in enumerate(names):		# Going through all the features
+			ax=fig.add_subplot(n_rows,n_cols,i+1)
+			ax.set_title(col_name)
+			for j, gr_feature_name in enumerate(gr["labels"]):			# Going through the values of grouping feature (here malignant and benign)
+				draw_histogram(ax, edges[i], counts[j, i], alpha=0.5, label=gr_feature_name)
+			plt.legend(loc='upper right')
 		fig.tight_layout() 
 		plt.savefig("./{0}/all_hist_grouped.png".format(folder), bbox_inches='tight')
 		plt.show()
 
 
-	def plot_corr():
-		''' Plotting correlations'''
+	def plot_corr(cluster=False):
+		''' Plotting correlations as one image, optionally with the features ordered by hierarchical clustering'''
+		import matplotlib.pyplot as plt
 		folder = "corr_{0}".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
-		if c_flag == True:
-			df.drop(['target'],axis=1)
-			number = len(df.columns)-1
-		else: number = len(df.columns)
-		cor = df.corr()
-		fig = plt.figure(figsize=(11, 11))
-		plt.imshow(cor, interpolation='nearest')
-		
-		im_ticks = range(number)
-		plt.tick_params(top=True, bottom=False, labeltop=True, labelbottom=False)
-		mask = np.zeros_like(cor)
-		mask[np.triu_indices_from(mask)] = True
-
-		plt.xticks(im_ticks, df.columns,  rotation=45)
-		plt.yticks(im_ticks, df.columns)
-		for i in range(number):
-			for j in range(number):
-				text = plt.text(j, i, (cor.iloc[i, j]).round(2), ha="center", va="center", color="w")
+		st = feature_stats()
+		cor = st['all'].correlation()			# from the co-moments accumulated in row blocks
+		names = np.array(st['names'], dtype=object)
+		if cluster:
+			order = cluster_order(cor)
+			cor = cor[np.ix_(order, order)]
+			names = names[order]
+		number = len(names)
+		labels = number <= CORR_LABELS_MAX
+		size = 11 if not labels else min(40, max(11, number * 0.25))
+
+		fig = plt.figure(figsize=(size, size))
+		plt.imshow(cor, interpolation='nearest', vmin=-1, vmax=1)
+		if labels:
+			plt.tick_params(top=True, bottom=False, labeltop=True, labelbottom=False)
+			plt.xticks(range(number), names, rotation=45, ha='left')
+			plt.yticks(range(number), names)
+		else:
+			plt.xticks([])
+			plt.yticks([])
+
+		# Annotating every cell of small matrices, only the strongest off-diagonal coefficients of large ones
+		if number <= CORR_ANNOTATE_ALL:
+			rows, cols = np.indices(cor.shape).reshape(2, -1)
+		else:
+			rows, cols = np.nonzero(np.triu(np.abs(np.nan_to_num(cor)) >= CORR_ANNOTATE_THRESHOLD, k=1))
+			strongest = np.argsort(-np.abs(cor[rows, cols]), kind='stable')[:CORR_ANNOTATE_LIMIT]
+			rows, cols = rows[strongest], cols[strongest]
+		fontsize = 10 if number <= CORR_ANNOTATE_ALL else max(3, 200 / number)
+		for i, j in zip(rows, cols):
+			plt.text(j, i, '{0:.2f}'.format(cor[i, j]), ha="center", va="center", color="w", fontsize=fontsize)
 		plt.colorbar()
 
 		plt.savefig(("./{0}/{1}.png".format(folder,dataset_name)), bbox_inches='tight')
 		plt.close('all')
 
 
+	templates = dict()			# Scatter figures built once per dataset, reused for every pair
+
+	def class_rows():
+		'''Rows of df that belong to a class, their class codes and the number of classes (the rows are sorted by class)'''
+		if c_flag != True:
+			return slice(None), None, 0
+		if 'codes' not in templates:
+			bounds = gr["data"].bounds
+			templates['codes'] = slice(bounds[0], bounds[-1]), np.repeat(np.arange(len(bounds) - 1), np.diff(bounds)), len(bounds) - 1
+		return templates['codes']
+
+	def axis_limits(values):
+		'''Data range with the 5% margin matplotlib adds when autoscaling'''
+		lo, hi = np.nanmin(values), np.nanmax(values)
+		pad = (hi - lo) * 0.05 if hi > lo else 0.5
+		return lo - pad, hi + pad
+
+	def scatter_template():
+		'''Figure with one empty collection per class, only offsets, labels and limits change per pair'''
+		from matplotlib.figure import Figure
+		fig = Figure()
+		ax = fig.subplots()
+		fig.subplots_adjust(**SCATTER_MARGINS)		# fixed layout: a tight bounding box would draw every figure twice
+		collections = []
+		if c_flag == True:
+			for i in range(len(gr["data"])):
+				collections.append((ax.scatter([], [], label=gr["labels"][i]), gr["data"][i]))
+			ax.legend(loc='upper right')
+		else:
+			collections.append((ax.scatter([], []), df))
+		images = []
+		if len(df) > density_rows:			# one shaded image per class instead of the markers
+			for coll, _ in collections:
+				images.append(ax.imshow(np.zeros((1, 1, 4)), origin='lower', aspect='auto', interpolation='nearest'))
+		return fig, ax, collections, images
+
+	def scatter_new_template():
+		'''Figure with two collections per class at fixed jittered class positions'''
+		from matplotlib.figure import Figure
+		fig = Figure()
+		ax = fig.subplots()
+		fig.subplots_adjust(**SCATTER_MARGINS)
+		width=0.4
+		collections = []
+		for i in range(len(gr["data"])):
+			data_gr = gr["data"][i]
+			if len(df) > density_rows:		# the jitter is uniform, so a column of the 1-D density stands for it
+				band = (i - width/2., i + width/2., 0, 1)
+				collections.append((ax.imshow(np.zeros((1, 1, 4)), extent=band, origin='lower', aspect='auto', interpolation='nearest'),
+					ax.imshow(np.zeros((1, 1, 4)), extent=band, origin='lower', aspect='auto', interpolation='nearest'), data_gr, None))
+				continue
+			z = np.ones(data_gr.shape[0])*i + (np.random.rand(data_gr.shape[0])*width-width/2.)
+			collections.append((ax.scatter([], [], c='orange', alpha=0.5), ax.scatter([], [], c='dodgerblue', alpha=0.5), data_gr, z))
+		ax.set_xticks(range(len(gr["labels"])))
+		ax.set_xticklabels(gr["labels"])
+		ax.set_xlim(-0.5 - width, len(gr["labels"]) - 0.5 + width)
+		ax.plot([], c='orange', label=' ')
+		ax.plot([], c='dodgerblue', label=' ')
+		legend = ax.legend(loc='upper right')
+		return fig, ax, collections, legend
+
 	def plot_scatter(f1, f2):
 		'''Scatter for each pair of features'''
 		folder = "scatter_{0}".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
-		
-		mean_f1 = np.mean(df[f1])
-		mean_f2 = np.mean(df[f2])
-		fig = plt.figure()
-		plt.xlabel(f1)
-		plt.ylabel(f2)
-
-		if c_flag == True:
-			for i in range(len(gr["data"])):
-				data_gr = gr["data"][i]
-				label_gr = gr["labels"][i]
-				x = data_gr.loc[:,f1]
-				y = data_gr.loc[:,f2]
-				plt.scatter(x, y, label=label_gr)
+		if 'scatter' not in templates:
+			templates['scatter'] = scatter_template()
+		fig, ax, collections, images = templates['scatter']
+		xlim = axis_limits(df[f1].values)
+		ylim = axis_limits(df[f2].values)
+
+		if images:			# render time depends on the raster size, not on the number of rows
+			rows, codes, n_classes = class_rows()
+			counts = density_grid([df[f1].values[rows], df[f2].values[rows]], [xlim, ylim], codes, n_classes)
+			for image, (coll, _), c in zip(images, collections, counts):
+				image.set_data(density_rgba(c.T, coll.get_facecolor()[0]))
+				image.set_extent(xlim + ylim)
 		else:
-			x = df.loc[:,f1]
-			y = df.loc[:,f2]
-			plt.scatter(x, y)
+			for coll, data_gr in collections:
+				coll.set_offsets(np.column_stack((data_gr[f1].values, data_gr[f2].values)))
+		ax.set_xlabel(f1)
+		ax.set_ylabel(f2)
+		ax.set_xlim(*xlim)
+		ax.set_ylim(*ylim)
 		#plt.scatter(mean_f1, mean_f2, color='g', marker='D', label='mean value')
-		plt.legend(loc='upper right')
-		plt.savefig(("./{0}/{1}-{2}.png".format(folder, f1.replace('/','-'), f2.replace('/','-'))), bbox_inches='tight')
-		plt.close('all')
+		fig.savefig(("./{0}/{1}-{2}.png".format(folder, f1.replace('/','-'), f2.replace('/','-'))))
 
 	def plot_scatter_new(f1, f2):
 		'''Scatter for each pair of features against class'''
+		from sklearn.preprocessing import normalize
+		if c_flag != True:
+			return
 		folder = "scatter_{0}_new".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
-		
-		mean_f1 = np.mean(df[f1])
-		mean_f2 = np.mean(df[f2])
-		fig, ax = plt.subplots()
-		width=0.4
-
-		if c_flag == True:
-			for i in range(len(gr["data"])):
-				data_gr = gr["data"][i]
-				label_gr = gr["labels"][i]
-				x = data_gr.loc[:,f1].as_matrix().reshape(1,len(data_gr.loc[:,f1]))
-				x = normalize(x)
-				y =data_gr.loc[:,f2].as_matrix().reshape(1,len(data_gr.loc[:,f2]))
-				y = normalize(y)
-				#z = data_gr.loc[:,'target']
-				z = np.ones(data_gr.shape[0])*i + (np.random.rand(data_gr.shape[0])*width-width/2.)
-				#print(label_gr, ' : ', z)
-				
-				plt.scatter(z, x, c='orange', alpha=0.5)
-				plt.scatter(z, y, c='dodgerblue', alpha=0.5)
-		
-		ax.set_xticks(range(len(gr["labels"])))
-		ax.set_xticklabels(gr["labels"])
-		plt.plot([], c='orange', label=f1)
-		plt.plot([], c='dodgerblue', label=f2)
-		#plt.legend(f1,f2)
-		plt.legend(loc='upper right')
-		plt.savefig(("./{0}/{1}-{2}.png".format(folder, f1.replace('/','-'), f2.replace('/','-'))), bbox_inches='tight')
-		plt.close('all')
+		if 'scatter_new' not in templates:
+			templates['scatter_new'] = scatter_new_template()
+		fig, ax, collections, legend = templates['scatter_new']
+
+		bottom, top = np.inf, -np.inf			# the normalised values are negative where the feature is
+		values = []
+		for coll1, coll2, data_gr, z in collections:
+			x = normalize(data_gr[f1].values.reshape(1, -1)).ravel()
+			y = normalize(data_gr[f2].values.reshape(1, -1)).ravel()
+			if z is None:
+				values.append((x, y))
+			else:
+				coll1.set_offsets(np.column_stack((z, x)))
+				coll2.set_offsets(np.column_stack((z, y)))
+			bottom = min(bottom, x.min(initial=np.inf), y.min(initial=np.inf))
+			top = max(top, x.max(initial=-np.inf), y.max(initial=-np.inf))
+		ylim = axis_limits([bottom, top] if bottom <= top else [0, 0])
+		for (coll1, coll2, _, _), (x, y) in zip(collections, values):
+			for image, v, color in [(coll1, x, 'orange'), (coll2, y, 'dodgerblue')]:
+				# bins over the range of the values themselves, so none of them falls outside the raster
+				counts, edges = np.histogram(v, bins=DENSITY_BINS, range=(bottom, top))
+				image.set_data(density_rgba(counts[:, None], color, 0.5))
+				image.set_extent(tuple(image.get_extent()[:2]) + (edges[0], edges[-1]))
+		ax.set_ylim(*ylim)
+		legend.get_texts()[0].set_text(f1)
+		legend.get_texts()[1].set_text(f2)
+		fig.savefig(("./{0}/{1}-{2}.png".format(folder, f1.replace('/','-'), f2.replace('/','-'))))
 
 
 	def plot_scatter_3d(f1, f2, f3):
 		"3D scatter "
+		import matplotlib.pyplot as plt
+		from mpl_toolkits.mplot3d import Axes3D		# registers the 3d projection
 		folder = "scatter_{0}".format(dataset_name)
 		if not os.path.exists(folder):
 			os.makedirs(folder)
@@ -256,7 +917,17 @@ def all_functions(c_flag, df, gr):			#Closure that takes classification_flag, da
 		fig=plt.figure(figsize=(11, 6), dpi=100)
 		ax = fig.add_subplot(111, projection='3d')
 
-		if c_flag == True:
+		if len(df) > density_rows:
+			# one marker per occupied voxel, its opacity growing with the number of points in it
+			limits = [axis_limits(df[f].values) for f in (f1, f2, f3)]
+			rows, codes, n_classes = class_rows()
+			counts = density_grid([df[f].values[rows] for f in (f1, f2, f3)], limits, codes, n_classes, DENSITY_BINS_3D)
+			centers = [lo + (np.arange(DENSITY_BINS_3D) + 0.5) * (hi - lo) / DENSITY_BINS_3D for lo, hi in limits]
+			for i, c in enumerate(counts):
+				ix, iy, iz = np.nonzero(c)
+				ax.scatter(centers[0][ix], centers[1][iy], centers[2][iz], c=density_rgba(c[ix, iy, iz], 'C{0}'.format(i)),
+					depthshade=False, label=gr["labels"][i] if c_flag == True else None)
+		elif c_flag == True:
 			for i in range(len(gr["data"])):
 				data_gr = gr["data"][i]
 				label_gr = gr["labels"][i]
@@ -280,79 +951,91 @@ def all_functions(c_flag, df, gr):			#Closure that takes classification_flag, da
 
 
 	def plot_box():
-		'''Box plot for each feature'''
+		'''Box plots of all the features in one report, switched with a dropdown'''
 		if c_flag == True:
 
 			folder = "box_{0}".format(dataset_name)
 			if not os.path.exists(folder):
 				os.makedirs(folder)
-			columns = df.columns
+			columns = [col for col in df.columns if col != 'target']
 			
-			for i in range(len(columns)-1):
-				trace = []
-				for j in range(len(gr["data"])):
+			data = []
+			buttons = []
+			n_classes = len(gr["data"])
+			for i, col_name in enumerate(columns):
+				for j in range(n_classes):
 					data_gr = gr["data"][j]
 					label_gr = gr["labels"][j]
 					c = "rgb(" + str(50*j+128) + ", " + str(128+j) + ", " + str(128+j*50) + ")"
-					trace.append(go.Box(
-						y=data_gr[columns[i]],
-						name = label_gr,
+					data.append(dict(
+						type = 'box',
+						y = typed_array(data_gr[col_name].values),
+						name = str(label_gr),
+						visible = (i == 0),
 						boxpoints = 'suspectedoutliers',
 						marker = dict(
 						color = c,
 						outliercolor = 'rgba(219, 64, 82, 0.6)'
 						)
 					))
-				data = trace #[trace0, trace1]
-				layout = go.Layout(
-				yaxis=dict(
-					title=columns[i],
-					zeroline=False
-					),
-					showlegend = True,
-					height = 700,
-					width = 1300,
-					title='Box plot grouped by Class(target)'
-					#boxmode='group'
-				)
-				fig = go.Figure(data=data, layout=layout)
-				plot(fig, filename="./{0}/box_plot_{1}.html".format(folder,columns[i].replace('/','-')), auto_open=False)
+				visible = [k // n_classes == i for k in range(len(columns) * n_classes)]
+				buttons.append(dict(label=col_name, method='update', args=[dict(visible=visible), {'yaxis.title.text': col_name}]))
+			layout = dict(
+			yaxis=dict(
+				title=dict(text=columns[0]),
+				zeroline=False
+				),
+				showlegend = True,
+				height = 700,
+				width = 1300,
+				title='Box plot grouped by Class(target)',
+				updatemenus = [dict(buttons=buttons, x=0, xanchor='left', y=1.12, yanchor='top')]
+				#boxmode='group'
+			)
+			write_plotly_report("./{0}/box_report.html".format(folder), 'Box plots ' + dataset_name, data, layout)
 
 
 	def plot_3d_clustering (f1, f2, f3):
-		'''Plotting 3D cluster scatter'''	
+		'''Plotting 3D cluster scatter: a stratified sample of the points and the convex hull of every class'''
 		if c_flag == True:
 			folder = "3D_{0}".format(dataset_name)
 			if not os.path.exists(folder):
 				os.makedirs(folder)
 
 			clustered_data = []
+			samples = stratified_sample(gr["data"].bounds, CLUSTER_POINTS)
 
-		
 			for i in range(len(gr["data"])):
 				data_gr = gr["data"][i]
 				label_gr = gr["labels"][i]
 				c = "rgb(" + str(50*i+128) + ", " + str(128+i) + ", " + str(128+i*50) + ")"
 				cc = "rgb(" + str(50*i+50) + ", " + str(190+i*6) + ", " + str(200+i*50) + ")"
-				xx = data_gr.loc[:,f1]
-				yy = data_gr.loc[:,f2]
-				zz = data_gr.loc[:,f3]
+				points = data_gr[[f1, f2, f3]].values
+				sample = points[samples[i]]
 				scatter = dict(
 					mode = "markers",
-					name = label_gr,
+					name = str(label_gr),
 					type = "scatter3d",    
-					x = data_gr.loc[:,f1], y = data_gr.loc[:,f2], z = data_gr.loc[:,f3],
+					x = typed_array(sample[:, 0]), y = typed_array(sample[:, 1]), z = typed_array(sample[:, 2]),
 					marker = dict( size=2+i*2, color=cc )
 				)
 				clustered_data.append(scatter)
+				hull = convex_hull(points)
+				if hull is None:			# without scipy the browser computes the hull of the sample
+					vertices, faces = sample, None
+				else:
+					vertices, faces = hull
 				cluster = dict(
-					alphahull = 7,
-					name = label_gr,
+					name = str(label_gr),
 					opacity = 0.1,
 					type = "mesh3d",    
-					x = xx, y = yy, z = zz,
+					x = typed_array(vertices[:, 0]), y = typed_array(vertices[:, 1]), z = typed_array(vertices[:, 2]),
 					color = c
 				)
+				if faces is None:
+					cluster['alphahull'] = 0
+				else:
+					cluster.update(i=typed_array(faces[:, 0], 'int32'), j=typed_array(faces[:, 1], 'int32'), k=typed_array(faces[:, 2], 'int32'))
 				clustered_data.append(cluster)
 			layout = dict(
 				title = '3d point clustering',
@@ -362,41 +1045,712 @@ def all_functions(c_flag, df, gr):			#Closure that takes classification_flag, da
 					zaxis = dict( zeroline=False, title=f3 ),
 				)
 			)
-			fig = dict( data=clustered_data, layout=layout )
-			plot(fig, filename="./{0}/3D_{1}_{2}_{3}.html".format(folder,f1.replace('/','-'),f2.replace('/','-'),f3.replace('/','-')), auto_open=False)
+			write_plotly_report("./{0}/3D_{1}_{2}_{3}.html".format(folder,f1.replace('/','-'),f2.replace('/','-'),f3.replace('/','-')), '3D clustering ' + dataset_name, clustered_data, layout)
 
 	return plot_3d_clustering, find_mean_std, plot_box, plot_histograms, plot_histograms_grouped, plot_scatter_3d, plot_scatter, plot_scatter_new, plot_corr
 
+pair_renderers = []		# Functions called for every feature pair, inherited by the render workers
+
+def render_pair_batch(batch):
+	'''Worker: rendering a batch of feature pairs with the non-interactive Agg backend'''
+	import matplotlib.pyplot as plt
+	plt.switch_backend('Agg')
+	for f1, f2 in batch:
+		for render in pair_renderers:
+			render(f1, f2)
+	return len(batch)
+
+
+def render_scatter_pairs(pairs, renderers, workers=1):
+	'''Rendering scatter plots for every pair, serially or on a pool of worker processes'''
+	pair_renderers[:] = renderers
+	if workers <= 1:
+		for f1, f2 in pairs:
+			print('\n Plotting scatter of ', f1, 'and ', f2)
+			for render in pair_renderers:
+				render(f1, f2)
+		return
+
+	size = max(1, math.ceil(len(pairs) / (workers * 4)))		# a few batches per worker to balance the load
+	batches = [pairs[i:i+size] for i in range(0, len(pairs), size)]
+	print('\n Plotting scatter of {0} pairs on {1} workers'.format(len(pairs), workers))
+	with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+		done = 0
+		if trace_events is None:
+			results = pool.map(render_pair_batch, batches)
+		else:
+			results = traced_results(pool.map(functools.partial(collect_trace, render_pair_batch), batches))
+		for n in results:
+			done += n
+			print(' {0}/{1} pairs plotted'.format(done, len(pairs)))
+
+
+normalized_data = None		# Column-normalized copy of dataset.data, computed once per run
+column_norms = None			# Divisor of every column in normalized_data (1 for all-zero columns)
+
+def prepare_matrix():
+	'''Normalizing the full data matrix once so feature subsets can be selected by column index'''
+	global normalized_data, column_norms
+	if normalized_data is None:
+		from sklearn.preprocessing import normalize
+		#scaler = StandardScaler()
+		#X = scaler.fit_transform(X)
+		normalized_data, norms = normalize(dataset.data, axis=0, return_norm=True)	# column norms don't depend on the other columns
+		column_norms = np.where(norms == 0, 1, norms)
+	return normalized_data, dataset.target
+
+
+def save_models(fitted):
+	'''Saving the fitted models with the features and column norms they expect (served by serve.py)
+
+	fitted: dict (model, 'all' | 'chosen') -> (estimator, column indices or None, mean cross-validation score,
+	(components, solver) of the PCA projection the estimator was fitted on, or None)
+	'''
+	folder = "results_{0}".format(dataset_name)
+	if not os.path.exists(folder):
+		os.makedirs(folder)
+	models = dict()
+	for (name, feature_set), (clf, columns, cv_mean, pca) in fitted.items():
+		columns = list(range(len(dataset.feature_names))) if columns is None or pca else list(columns)
+		models['{0}/{1}'.format(name, feature_set)] = dict(
+			estimator = clf,
+			features = [str(dataset.feature_names[j]) for j in columns],
+			norms = column_norms[columns],
+			cv_mean = float(cv_mean)
+		)
+		if pca:			# raw rows are projected, then divided by the norms of the components
+			projection = pca_projection(*pca)
+			models['{0}/{1}'.format(name, feature_set)].update(pca=projection['pca'], norms=projection['norms'])
+	bundle = dict(dataset=dataset_name, target_names=[str(name) for name in dataset.target_names], models=models)
+	path = "./{0}/models.pkl".format(folder)
+	with open(path + '.tmp', 'wb') as f:
+		pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(path + '.tmp', path)
+	print('\n Saved {0} fitted models to {1}'.format(len(models), path))
+
+
+def feature_columns(*features):
+	'''Indices of the chosen feature names, in the order given (empty names are skipped)'''
+	names = [str(name) for name in dataset.feature_names]
+	return [names.index(name) for name in features if name]
+
+
 def set_data_analyse(f1, f2, f3):
-	if f3:
-		X = np.empty(shape=[len(dataset.data), 3])
-	else: 
-		X = np.empty(shape=[len(dataset.data), 2])
-	y = np.empty(shape=[len(dataset.data),])
-	l = []
-	k = 0
-	for j, c in enumerate(dataset.feature_names):
-		if dataset.feature_names[j] == f1 or dataset.feature_names[j] == f2  or dataset.feature_names[j] == f3: 
-			for i, s in enumerate(dataset.data):
-				X[i,k] = dataset.data[i,j]
-				y[i] = dataset.target[i]
-			l.append(dataset.feature_names[j])
-			k = k+1
-
-	#scaler = StandardScaler()
-	#X = scaler.fit_transform(X)
-	X = normalize(X, axis=0)
-	return X, y, l
-
-def set_data_analyse_PCA(n):
-	from sklearn.decomposition import PCA
-	pca = PCA(n_components=n)
-	X = pca.fit_transform(dataset.data)
-	y = dataset.target
-	X = normalize(X, axis=0)	
-	return X, y
+	'''Selecting 2 or 3 chosen columns from the normalized data'''
+	X, y = prepare_matrix()
+	columns = feature_columns(f1, f2, f3)
+	l = [dataset.feature_names[j] for j in columns]
+	return X[:, columns], y, l
+
+
+cache_dir = '.analyse_cache'		# Persistent cache of fold scores and fitted estimators, None disables it
+cache_max_bytes = 512 * 2**20		# Least recently used entries are evicted above this size
+
+def fingerprint(*parts):
+	'''Stable hash of arrays, estimator parameters and plain values'''
+	h = hashlib.sha1()
+	for part in parts:
+		if isinstance(part, np.ndarray):
+			a = np.ascontiguousarray(part)
+			h.update('{0}{1}'.format(a.dtype.str, a.shape).encode())
+			h.update(a.data)
+		elif hasattr(part, 'get_params'):			# sklearn estimator
+			h.update(type(part).__name__.encode())
+			h.update(repr(sorted(part.get_params().items())).encode())
+		elif isinstance(part, bytes):
+			h.update(part)
+		else:
+			h.update(repr(part).encode())
+		h.update(b'|')
+	return h.hexdigest()
+
+
+def cache_get(key):
+	'''Reading a cache entry, None if it is missing or caching is off'''
+	if cache_dir is None:
+		return None
+	path = os.path.join(cache_dir, key + '.pkl')
+	try:
+		with open(path, 'rb') as f:
+			value = pickle.load(f)
+		os.utime(path)			# marking the entry as recently used
+	except (OSError, EOFError, pickle.UnpicklingError):
+		return None
+	return value
+
+
+def cache_put(key, value):
+	'''Writing a cache entry atomically so concurrent workers never read a partial file'''
+	if cache_dir is None:
+		return
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir, exist_ok=True)
+	path = os.path.join(cache_dir, key + '.pkl')
+	tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+	with open(tmp, 'wb') as f:
+		pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp, path)
+
+
+def cache_evict():
+	'''Removing least recently used entries until the cache fits into cache_max_bytes'''
+	if cache_dir is None or not os.path.exists(cache_dir):
+		return
+	entries = []
+	for entry in os.scandir(cache_dir):
+		if entry.name.endswith('.pkl'):
+			st = entry.stat()
+			entries.append((st.st_mtime, st.st_size, entry.path))
+	total = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total <= cache_max_bytes:
+			break
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		total -= size
+
+
+def fit_cached(clf, X_train, y_train, features):
+	'''Fitting an estimator or reusing the fit cached for the same data, features and parameters'''
+	key = fingerprint('fit', X_train, y_train, [str(f) for f in features], clf)
+	fitted = cache_get(key)
+	if fitted is None:
+		fitted = clf.fit(X_train, y_train)
+		cache_put(key, fitted)
+	return fitted
+
+
+n_jobs = None			# Worker processes for cross-validation, None means one per core
+cv_arrays = dict()		# Arrays visible to cross-validation jobs in the current process
+cv_blocks = []			# Shared memory blocks attached by a worker (kept open for its lifetime)
+
+def share_arrays(arrays):
+	'''Copying arrays into shared memory once, returning the blocks and the specs the workers attach to'''
+	blocks = []
+	specs = dict()
+	for key, a in arrays.items():
+		a = np.ascontiguousarray(a)
+		shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+		np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+		blocks.append(shm)
+		specs[key] = (shm.name, a.shape, a.dtype.str)
+	return blocks, specs
+
+
+def attach_arrays(specs):
+	'''Pool initializer: mapping the shared blocks into the worker without copying'''
+	for key, (name, shape, dtype) in specs.items():
+		shm = shared_memory.SharedMemory(name=name)
+		cv_blocks.append(shm)
+		cv_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def run_cv_job(job):
+	'''Fitting and scoring one (model, feature set, fold) job on the shared arrays'''
+	key, matrix, columns, model, n_splits, fold, max_train, cache_key = job
+	with traced('cv ' + (' '.join(str(k) for k in key) if isinstance(key, tuple) else str(key)), 'cv', fold=fold) as info:
+		entry = cache_get(cache_key) if cache_key else None
+		info['cached'] = entry is not None
+		if entry is not None:
+			return key, fold, entry['score']
+		from sklearn import base, metrics, model_selection
+
+		X = cv_arrays[matrix]
+		if columns is not None:
+			X = X[:, columns]
+		y = cv_arrays['y']
+		train, test = next(itertools.islice(model_selection.KFold(n_splits=n_splits).split(X), fold, None))
+		if max_train:			# reduced budget: a fixed random subset of the training rows
+			train = np.random.RandomState(fold).permutation(train)[:max_train]
+		clf = base.clone(model).fit(X[train], y[train])
+		y_pred = clf.predict(X[test])
+		entry = dict(
+			score = metrics.accuracy_score(y[test], y_pred),
+			confusion = metrics.confusion_matrix(y[test], y_pred, labels=np.unique(y)),
+			estimator = clf
+		)
+		if cache_key:
+			cache_put(cache_key, entry)
+		return key, fold, entry['score']
+
+
+def run_cv_jobs(tasks, arrays, jobs=None, cache=True):
+	'''Running cross-validation tasks as one flat graph of fold jobs on a process pool
+
+	tasks: list of (key, matrix name, column indices or None, model, number of folds[, maximum training rows])
+	Matrix 'X' holds the columns of dataset.data, other matrices are named only by their content.
+	arrays: dict of matrices used by the tasks plus the target under 'y'
+	cache: False to bypass the persistent cache, for many cheap jobs whose pickled estimators
+	would cost more to write and look up than to refit (the feature subset sweep, the short tuning rounds)
+	Returns a dict: key -> array of fold accuracies in fold order
+	'''
+	jobs = jobs or n_jobs or os.cpu_count()
+	cache = cache and cache_dir is not None
+	scores = dict()
+	fold_jobs = []
+	data_keys = dict()
+	if cache:
+		data_keys = {name: fingerprint(a, arrays['y']) for name, a in arrays.items() if name != 'y'}
+	for task in tasks:
+		key, matrix, columns, model, n_splits = task[:5]
+		max_train = task[5] if len(task) > 5 else None
+		scores[key] = np.empty(n_splits)
+		if matrix == 'X':
+			features = [str(dataset.feature_names[j]) for j in (range(len(dataset.feature_names)) if columns is None else columns)]
+		else:			# derived matrices (chosen columns, projections) are identified by their data hash
+			features = [matrix, None if columns is None else list(columns)]
+		for fold in range(n_splits):
+			# Cache entry: data, selected features, estimator parameters and the (unshuffled) KFold split
+			cache_key = None
+			if cache:
+				cache_key = fingerprint('cv', data_keys[matrix], features, model, 'KFold', n_splits, None, fold, max_train)
+			fold_jobs.append((key, matrix, columns, model, n_splits, fold, max_train, cache_key))
+
+	if jobs == 1 or len(fold_jobs) == 1:
+		cv_arrays.update(arrays)
+		for job in fold_jobs:
+			key, fold, score = run_cv_job(job)
+			scores[key][fold] = score
+		cache_evict()
+		return scores
+
+	blocks, specs = share_arrays(arrays)
+	try:
+		with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'), initializer=attach_arrays, initargs=(specs,)) as pool:
+			chunk = max(1, len(fold_jobs) // (jobs * 4))
+			if trace_events is None:
+				results = pool.map(run_cv_job, fold_jobs, chunksize=chunk)
+			else:
+				results = traced_results(pool.map(functools.partial(collect_trace, run_cv_job), fold_jobs, chunksize=chunk))
+			for key, fold, score in results:
+				scores[key][fold] = score
+	finally:
+		for shm in blocks:
+			shm.close()
+			shm.unlink()
+	cache_evict()
+	return scores
+
+
+GNB_BATCH_CELLS = 1 << 22		# size of the (rows, classes, subsets, features) block scored at once
+
+
+def gnb_fold_scores(X, y, subsets, n_splits=10, var_smoothing=1e-9):
+	'''Cross-validating GaussianNB on many feature subsets at once, without fitting estimators
+
+	The class counts, sums and sums of squares of every fold's test rows are accumulated for every
+	feature in row blocks, and each fold's training statistics are the class totals minus its own,
+	so the means, variances and priors of any subset are plain lookups. Every row is then scored
+	with the statistics of the fold it is held out from, in blocks of at most GNB_BATCH_CELLS
+	(rows, classes, subsets, features) cells, so memory stays bounded however many rows there are.
+	subsets: list of column index tuples of the same length (None: all the columns)
+	Returns fold accuracies of shape (len(subsets), n_splits), the same as cross_val_score with KFold.
+	'''
+	from sklearn import model_selection
+	X = np.asarray(X)
+	n, n_features = X.shape
+	centre = X.mean(axis=0, dtype=np.float64)		# variances are shift invariant, centring keeps the sums of squares accurate
+	subsets = np.array([range(n_features) if s is None else s for s in subsets], dtype=np.intp).reshape(len(subsets), -1)
+	classes, codes = np.unique(y, return_inverse=True)
+	n_classes = len(classes)
+
+	fold_of = np.empty(n, dtype=np.intp)
+	for fold, (train, test) in enumerate(model_selection.KFold(n_splits=n_splits).split(X)):
+		fold_of[test] = fold
+	test_rows = np.bincount(fold_of, minlength=n_splits)
+
+	test_counts = np.zeros(n_splits * n_classes)
+	test_sums = np.zeros((n_splits * n_classes, n_features))
+	test_squares = np.zeros((n_splits * n_classes, n_features))
+	rows = max(1, GNB_BATCH_CELLS // max(n_features, n_splits * n_classes))
+	for r in range(0, n, rows):
+		x = np.asarray(X[r:r + rows], dtype=np.float64) - centre
+		member = np.eye(n_splits * n_classes)[fold_of[r:r + rows] * n_classes + codes[r:r + rows]]		# (rows, fold and class)
+		test_counts += member.sum(axis=0)
+		test_sums += member.T @ x
+		test_squares += member.T @ x**2
+	test_counts = test_counts.reshape(n_splits, n_classes)
+	test_sums = test_sums.reshape(n_splits, n_classes, n_features)
+	test_squares = test_squares.reshape(n_splits, n_classes, n_features)
+	counts = test_counts.sum(axis=0) - test_counts		# (folds, classes): training rows of each fold and class
+	sums = test_sums.sum(axis=0) - test_sums		# (folds, classes, features)
+	squares = test_squares.sum(axis=0) - test_squares
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means = sums / counts[:, :, None]
+		variances = np.maximum(squares / counts[:, :, None] - means**2, 0)
+		log_priors = np.log(counts / counts.sum(axis=1, keepdims=True))		# -inf for a class missing from a fold
+	n_train = counts.sum(axis=1)[:, None]
+	train_variances = squares.sum(axis=1) / n_train - (sums.sum(axis=1) / n_train)**2		# (folds, features)
+
+	scores = np.empty((len(subsets), n_splits))
+	step = max(1, GNB_BATCH_CELLS // (n * n_classes * subsets.shape[1]))
+	for start in range(0, len(subsets), step):
+		batch = subsets[start:start + step]		# (subsets, features)
+		epsilon = var_smoothing * train_variances[:, batch].max(axis=2)		# (folds, subsets)
+		fold_theta = means[:, :, batch]			# (folds, classes, subsets, features)
+		fold_sigma = variances[:, :, batch] + epsilon[:, None, :, None]
+		fold_norm = np.log(2 * np.pi * fold_sigma).sum(axis=3)		# (folds, classes, subsets)
+		hits = np.zeros((n_splits, len(batch)))
+		rows = max(1, GNB_BATCH_CELLS // (n_classes * batch.size))		# a few subsets of many rows are scored in row blocks
+		for r in range(0, n, rows):
+			block = fold_of[r:r + rows]
+			x = (np.asarray(X[r:r + rows], dtype=np.float64) - centre)[:, batch][:, None]
+			d = x - fold_theta[block]		# (rows, classes, subsets, features)
+			d **= 2
+			d /= fold_sigma[block]
+			joint = -0.5 * fold_norm[block] - 0.5 * d.sum(axis=3)
+			joint = np.where(np.isinf(log_priors)[block][:, :, None], -np.inf, joint + log_priors[block][:, :, None])
+			correct = joint.argmax(axis=1) == codes[r:r + rows, None]		# (rows, subsets)
+			hits += np.eye(n_splits)[block].T @ correct
+		scores[start:start + step] = (hits / test_rows[:, None]).T
+	return scores
+
+
+def sweep_subsets(sizes=(2, 3), n_splits=10):
+	'''Cross-validating tuned GaussianNB, SVC and KNN on every combination of 2 and 3 features'''
+	from sklearn.naive_bayes import GaussianNB
+	from sklearn.svm import SVC
+	folder = "results_{0}".format(dataset_name)
+	if not os.path.exists(folder):
+		os.makedirs(folder)
+
+	models = []
+	models.append(('NB', GaussianNB()))
+	models.append(('SVC', SVC(C=100, kernel='rbf', gamma='scale')))
+	models.append(('KNN', make_model('KNN', dict(n_neighbors=5, weights='uniform'))))
+
+	X, y = prepare_matrix()
+	tasks = []
+	nb_scores = dict()
+	for size in sizes:
+		subsets = list(itertools.combinations(range(X.shape[1]), size))
+		print('\n Sweeping {0} combinations of {1} features'.format(len(subsets), size))
+		# GaussianNB is scored for all the subsets of one size in a single tensor pass
+		nb_scores.update(zip([('NB', columns) for columns in subsets], gnb_fold_scores(X, y, subsets, n_splits)))
+		for columns in subsets:
+			for name, model in models:
+				if name != 'NB':
+					tasks.append(((name, columns), 'X', list(columns), model, n_splits))
+	# thousands of small fits: refitting is cheaper than pickling every fold's estimator
+	scores = run_cv_jobs(tasks, {'X': X, 'y': y}, cache=False)
+	scores.update(nb_scores)
+
+	rows = []
+	for (name, columns), cvs in scores.items():
+		rows.append([name, len(columns), ' | '.join(dataset.feature_names[j] for j in columns), np.mean(cvs), np.std(cvs)])
+
+	# Ranked table: best mean cross-validation score first
+	rows.sort(key=lambda r: (-r[3], r[4]))
+	with open("./{0}/sweep_ranked.csv".format(folder), 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['rank', 'model', 'n_features', 'features', 'mean_cvs', 'std_cvs'])
+		for rank, r in enumerate(rows, start=1):
+			writer.writerow([rank] + r[:3] + ['{0:.4f}'.format(r[3]), '{0:.4f}'.format(r[4])])
+
+	print('\n Top 10 feature subsets:')
+	for rank, r in enumerate(rows[:10], start=1):
+		print('{0:>3}. {1:<4} {2:.4f} (+/- {3:.4f})  {4}'.format(rank, r[0], r[3], r[4], r[2]))
+	return rows
+
+PCA_SOLVERS = ['full', 'randomized', 'incremental']
+PCA_CHUNK_ROWS = 10000		# Rows per partial_fit/transform call of the incremental solver
+pca_projections = dict()	# Projections computed in this run, by (n, solver, chunk rows)
+data_key = None				# Fingerprint of the loaded dataset, computed once per run by run_dataset
+
+def pca_projection(n, solver='full', chunk_rows=PCA_CHUNK_ROWS):
+	'''Fitting the first n principal components of dataset.data once per run (and in the persistent cache)
+
+	solver: 'full' (exact SVD), 'randomized' (truncated randomized SVD) or 'incremental'
+	(IncrementalPCA fitted and applied chunk by chunk, for data that doesn't fit in memory).
+	Returns a dict with the fitted estimator, the normalized projection X and its column norms.
+	'''
+	from sklearn.decomposition import PCA, IncrementalPCA
+	from sklearn.preprocessing import normalize
+	data = dataset.data
+	settings = (n, solver, chunk_rows if solver == 'incremental' else None)
+	if settings in pca_projections:
+		return pca_projections[settings]
+	# the data is hashed once per run, not on every call (it may be a large memory-mapped table)
+	key = fingerprint('pca', np.asarray(data) if data_key is None else data_key, *settings)
+	projection = cache_get(key)
+	if projection is None:
+		if solver == 'incremental':
+			# chunks of at least n rows, the short remainder joins the last chunk
+			step = max(n, chunk_rows)
+			bounds = list(range(0, len(data), step))
+			if len(bounds) > 1 and len(data) - bounds[-1] < n:
+				bounds.pop()
+			bounds.append(len(data))
+			pca = IncrementalPCA(n_components=n)
+			for a, b in zip(bounds[:-1], bounds[1:]):
+				pca.partial_fit(np.asarray(data[a:b], dtype=np.float64))
+			X = np.empty((len(data), n))
+			for a, b in zip(bounds[:-1], bounds[1:]):
+				X[a:b] = pca.transform(np.asarray(data[a:b], dtype=np.float64))
+		else:
+			pca = PCA(n_components=n, svd_solver=solver, random_state=0 if solver == 'randomized' else None)
+			X = pca.fit_transform(np.asarray(data))
+		X, norms = normalize(X, axis=0, return_norm=True)
+		projection = dict(pca=pca, X=X, norms=np.where(norms == 0, 1, norms))
+		cache_put(key, projection)
+	print('\n PCA ({0} solver): {1} components explain {2:.1%} of the variance'.format(solver, n, projection['pca'].explained_variance_ratio_.sum()))
+	pca_projections[settings] = projection
+	return projection
+
+
+def set_data_analyse_PCA(n, solver='full'):
+	'''First n principal components of the data, normalized like the chosen columns'''
+	projection = pca_projection(n, solver)
+	return projection['X'], dataset.target, ['PC{0}'.format(i + 1) for i in range(n)]
+
+
+SURFACE_RESOLUTION = 200		# Coarse decision-surface cells per axis
+SURFACE_REFINE = 4				# Sub-cells per axis for coarse cells on a class boundary
+PREDICT_CHUNK = 65536			# Maximum number of points passed to one predict call
+
+def predict_chunked(clf, points, chunk_size=PREDICT_CHUNK):
+	'''Predicting in bounded-size chunks so temporary arrays don't grow with the grid'''
+	if len(points) == 0:
+		return np.empty(0, dtype=int)
+	return np.concatenate([clf.predict(points[i:i+chunk_size]) for i in range(0, len(points), chunk_size)])
+
+
+def decision_surface(clf, x_min, x_max, y_min, y_max, resolution=SURFACE_RESOLUTION, refine=SURFACE_REFINE):
+	'''Predicting a fixed-budget grid and refining only the cells where neighbouring predictions disagree'''
+	x_edges = np.linspace(x_min, x_max, resolution*refine + 1)		# edges of the fine grid
+	y_edges = np.linspace(y_min, y_max, resolution*refine + 1)
+	x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+	y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+
+	# Coarse pass: one prediction in the middle of each coarse cell
+	cx = np.linspace(x_min, x_max, resolution + 1)
+	cy = np.linspace(y_min, y_max, resolution + 1)
+	cxx, cyy = np.meshgrid((cx[:-1] + cx[1:]) / 2, (cy[:-1] + cy[1:]) / 2)
+	Z = predict_chunked(clf, np.c_[cxx.ravel(), cyy.ravel()]).reshape(cxx.shape)
+
+	# Coarse cells that differ from one of their 4 neighbours lie on a class boundary
+	boundary = np.zeros(Z.shape, dtype=bool)
+	d = Z[:, 1:] != Z[:, :-1]
+	boundary[:, 1:] |= d
+	boundary[:, :-1] |= d
+	d = Z[1:, :] != Z[:-1, :]
+	boundary[1:, :] |= d
+	boundary[:-1, :] |= d
+
+	Z_fine = np.repeat(np.repeat(Z, refine, axis=0), refine, axis=1)
+	iy, ix = np.nonzero(boundary)
+	if len(iy):
+		# Fine pass: every sub-cell of the boundary cells
+		sub = np.arange(refine)
+		rows = np.broadcast_to((iy[:, None] * refine + sub)[:, :, None], (len(iy), refine, refine)).ravel()
+		cols = np.broadcast_to((ix[:, None] * refine + sub)[:, None, :], (len(ix), refine, refine)).ravel()
+		Z_fine[rows, cols] = predict_chunked(clf, np.c_[x_centers[cols], y_centers[rows]])
+	return x_edges, y_edges, Z_fine
+
+
+TUNED_PARAMS = dict()			# Tuned parameters per (model, feature set), found with GridSearchCV and a k loop
+TUNED_PARAMS[('NB', 'all')] = dict()
+TUNED_PARAMS[('NB', 'chosen')] = dict()
+TUNED_PARAMS[('SVC', 'all')] = dict(C=100, kernel='rbf', gamma='scale')
+TUNED_PARAMS[('SVC', 'chosen')] = dict(C=100, kernel='rbf', gamma='scale', random_state=None)
+TUNED_PARAMS[('KNN', 'all')] = dict(n_neighbors=1, weights='uniform')
+TUNED_PARAMS[('KNN', 'chosen')] = dict(n_neighbors=5, weights='uniform')
+
+SEARCH_SPACE = dict()			# Parameter grids sampled by the successive-halving search
+SEARCH_SPACE['NB'] = dict(var_smoothing=[1e-11, 1e-10, 1e-9, 1e-8, 1e-7, 1e-6, 1e-5])
+SEARCH_SPACE['SVC'] = dict(C=[0.01, 0.1, 1, 10, 100, 1000], kernel=['rbf', 'linear'], gamma=['scale', 'auto', 0.1, 1, 10, 100])
+SEARCH_SPACE['KNN'] = dict(n_neighbors=list(range(1, 31)), weights=['uniform', 'distance'])
+
+KNN_BACKENDS = ['auto', 'brute', 'kd_tree', 'ball_tree', 'lsh']
+knn_backend = 'auto'			# Neighbour search of the KNN models: sklearn's algorithm, or 'lsh' for the approximate index
+
+def make_model(name, params):
+	'''Building GaussianNB, SVC or KNN from a parameter dict'''
+	from sklearn.naive_bayes import GaussianNB
+	from sklearn.neighbors import KNeighborsClassifier
+	from sklearn.svm import SVC
+	if name == 'KNN' and knn_backend == 'lsh':
+		from neighbours import LSHNeighborsClassifier
+		return LSHNeighborsClassifier(**params)
+	if name == 'KNN':
+		params = dict(params, algorithm=knn_backend)
+	return dict(NB=GaussianNB, SVC=SVC, KNN=KNeighborsClassifier)[name](**params)
+
+
+def tune_models(X_chosen, n_candidates=27, eta=3, n_splits=5, seed=7):
+	'''Successive-halving search for every model on all the features and on the chosen feature set
+
+	Each search starts with n_candidates random configurations cross-validated on a small share of the
+	training rows. After every round only the best 1/eta of the configurations survive and the
+	number of training rows grows eta times, until one configuration remains on all the rows.
+	The rounds of all six searches run together as one graph on the process pool. Only the last
+	round's fits go to the persistent cache.
+	'''
+	from sklearn.model_selection import ParameterGrid
+	X, y = prepare_matrix()
+	rng = np.random.RandomState(seed)
+	n_train = len(y) - len(y) // n_splits
+	rounds = max(1, int(math.ceil(math.log(n_candidates, eta))))
+	min_train = max(n_splits * 4, max(SEARCH_SPACE['KNN']['n_neighbors']))		# every KNN candidate needs n_neighbors training rows
+
+	searches = dict()
+	for name, space in SEARCH_SPACE.items():
+		grid = list(ParameterGrid(space))
+		picked = rng.choice(len(grid), size=min(n_candidates, len(grid)), replace=False)
+		for feature_set in ['all', 'chosen']:
+			searches[(name, feature_set)] = [grid[i] for i in picked]
+
+	best = dict()
+	for r in range(rounds):
+		max_train = max(min_train, n_train // eta**(rounds - 1 - r))
+		if r == rounds - 1 or max_train >= n_train:
+			max_train = None			# last round on all the training rows
+		tasks = []
+		for (name, feature_set), candidates in searches.items():
+			for i, params in enumerate(candidates):
+				tasks.append(((name, feature_set, i), 'X' if feature_set == 'all' else 'C', None, make_model(name, params), n_splits, max_train))
+		# only the last round, on all the rows, is cached: the short rounds are many cheap fits
+		scores = run_cv_jobs(tasks, {'X': X, 'C': X_chosen, 'y': y}, cache=max_train is None)
+		print('\n Search round {0}: {1} configurations on {2} training rows'.format(r + 1, len(tasks), max_train or n_train))
+
+		for (name, feature_set), candidates in searches.items():
+			ranked = sorted(range(len(candidates)), key=lambda i: -np.mean(scores[(name, feature_set, i)]))
+			best[(name, feature_set)] = (candidates[ranked[0]], np.mean(scores[(name, feature_set, ranked[0])]))
+			searches[(name, feature_set)] = [candidates[i] for i in ranked[:max(1, int(math.ceil(len(candidates) / eta)))]]
+		if max_train is None:
+			break
+
+	tuned = dict()
+	for key, (params, score) in sorted(best.items()):
+		print(' Best {0} on {1} features: {2} (cross_val_score mean {3:.4f})'.format(key[0], key[1], params, score))
+		tuned[key] = params
+	return tuned
+
+
+def squared_distances(A, B):
+	'''Squared euclidean distances between the rows of A and the rows of B'''
+	d = (A**2).sum(axis=1)[:, None] - 2 * (A @ B.T) + (B**2).sum(axis=1)[None, :]
+	return np.maximum(d, 0, out=d)
+
+
+def score_k_and_C(X, y, ks=range(1, 11), Cs=(0.01, 0.1, 1, 10, 100, 1000), n_splits=10, backend='brute'):
+	'''Scoring every k of KNN and every C of the RBF SVC from one distance matrix per fold
+
+	The test-to-train distances are sorted once and the class votes are accumulated along the
+	neighbour list, so every k is read off the same array. With a backend other than brute force
+	the neighbour lists come from one index per fold, queried once for the largest k.
+	The RBF Gram matrices (gamma='scale') are built once per fold and every C is fitted with kernel='precomputed'.
+	Returns fold accuracies of shape (len(ks), n_splits) and (len(Cs), n_splits).
+	'''
+	from sklearn import model_selection
+	from sklearn.svm import SVC
+	X = np.asarray(X, dtype=np.float64)
+	classes, codes = np.unique(y, return_inverse=True)
+	ks = list(ks)
+	k_max = max(ks)
+	knn_scores = np.zeros((len(ks), n_splits))
+	svc_scores = np.zeros((len(Cs), n_splits))
+	for fold, (train, test) in enumerate(model_selection.KFold(n_splits=n_splits).split(X)):
+		X_train, X_test = X[train], X[test]
+		D_train = squared_distances(X_train, X_train)
+		D_test = squared_distances(X_test, X_train)
+
+		# KNN: votes of the k nearest neighbours for every k at once (ties go to the smallest class, like sklearn)
+		k = min(k_max, len(train))
+		if backend in ('auto', 'brute'):
+			nearest = np.argpartition(D_test, k - 1, axis=1)[:, :k]
+			nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(D_test, nearest, axis=1), axis=1, kind='stable'), axis=1)
+		else:
+			from neighbours import build_index
+			nearest = build_index(X_train, backend).kneighbors(X_test, k)[1]
+		votes = np.cumsum(np.eye(len(classes), dtype=np.int32)[codes[train][nearest]], axis=1)
+		for i, n in enumerate(ks):
+			knn_scores[i, fold] = np.mean(votes[:, min(n, k) - 1].argmax(axis=1) == codes[test])
+
+		# SVC: one Gram matrix for all the values of C
+		gamma = 1.0 / (X_train.shape[1] * X_train.var())
+		K_train = np.exp(-gamma * D_train)
+		K_test = np.exp(-gamma * D_test)
+		for i, C in enumerate(Cs):
+			clf = SVC(C=C, kernel='precomputed').fit(K_train, y[train])
+			svc_scores[i, fold] = np.mean(clf.predict(K_test) == y[test])
+	return knn_scores, svc_scores
+
+
+def compare_knn_backends(columns, k=10, n_splits=10):
+	'''Recall@k and speed-up of the KD-tree, ball tree and LSH indexes against exact search
+
+	Every fold's index is queried with the test rows, and for the chosen 2 features also with the
+	coarse decision-surface grid. Times are summed and recalls averaged over the folds. approximate
+	tells whether the LSH index ranked candidates or fell back to exact search on a small training set.
+	'''
+	from sklearn import model_selection
+	from neighbours import compare_backends
+	X, y = prepare_matrix()
+	X = np.asarray(X, dtype=np.float64)
+	rows = []
+	for feature_set, X_set in [('all', X), ('chosen', X[:, columns])]:
+		queries = ['test']
+		if X_set.shape[1] == 2:
+			queries.append('mesh')
+			cx = np.linspace(X_set[:, 0].min(), X_set[:, 0].max(), SURFACE_RESOLUTION)
+			cy = np.linspace(X_set[:, 1].min(), X_set[:, 1].max(), SURFACE_RESOLUTION)
+			cxx, cyy = np.meshgrid(cx, cy)
+			mesh = np.c_[cxx.ravel(), cyy.ravel()]
+		for query in queries:
+			total = dict()
+			for train, test in model_selection.KFold(n_splits=n_splits).split(X_set):
+				for r in compare_backends(X_set[train], X_set[test] if query == 'test' else mesh, k):
+					t = total.setdefault(r['backend'], dict(build_s=0.0, query_s=0.0, recall=0.0, approximate=False))
+					t['approximate'] |= r['approximate']
+					t['build_s'] += r['build_s']
+					t['query_s'] += r['query_s']
+					t['recall'] += r['recall'] / n_splits
+			exact = total['brute']['build_s'] + total['brute']['query_s']
+			for backend, t in total.items():
+				rows.append([backend, feature_set, X_set.shape[1], query, t['approximate'], t['build_s'], t['query_s'], exact / max(t['build_s'] + t['query_s'], 1e-12), t['recall']])
+	return rows
+
+
+def sweep_k_and_C(columns, ks=range(1, 11), Cs=(0.01, 0.1, 1, 10, 100, 1000), n_splits=10):
+	'''Table of KNN scores for every k and SVC scores for every C, on all the features and on the chosen ones'''
+	folder = "results_{0}".format(dataset_name)
+	if not os.path.exists(folder):
+		os.makedirs(folder)
+	X, y = prepare_matrix()
+	rows = []
+	for feature_set, X_set in [('all', X), ('chosen', X[:, columns])]:
+		knn_scores, svc_scores = score_k_and_C(X_set, y, ks, Cs, n_splits, knn_backend)
+		for n, cvs in zip(ks, knn_scores):
+			rows.append(['KNN', 'n_neighbors', n, feature_set, np.mean(cvs), np.std(cvs)])
+		for C, cvs in zip(Cs, svc_scores):
+			rows.append(['SVC', 'C', C, feature_set, np.mean(cvs), np.std(cvs)])
+
+	with open("./{0}/k_C_sweep.csv".format(folder), 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['model', 'parameter', 'value', 'features', 'mean_cvs', 'std_cvs'])
+		for r in rows:
+			writer.writerow(r[:4] + ['{0:.4f}'.format(r[4]), '{0:.4f}'.format(r[5])])
+	for r in rows:
+		print('{0:<4} {1}={2:<6} on {3:<6} features: {4:.4f} (+/- {5:.4f})'.format(*r))
+
+	print('\n Neighbour search backends against exact search ({0} neighbours, summed over {1} folds)'.format(max(ks), n_splits))
+	backends = compare_knn_backends(columns, max(ks), n_splits)
+	with open("./{0}/knn_backends.csv".format(folder), 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['backend', 'features', 'n_features', 'queries', 'approximate', 'build_s', 'query_s', 'speedup', 'recall'])
+		for r in backends:
+			writer.writerow(r[:5] + ['{0:.4f}'.format(v) for v in r[5:]])
+	for r in backends:
+		print('{0:<9} on {1:<6} features, {3:<4} queries: build {5:.3f} s, query {6:.3f} s, speed-up {7:.2f}x, recall {8:.4f}{9}'.format(*(r + ['' if r[4] or r[0] != 'lsh' else ' (exact fallback)'])))
+	return rows
+
 
 def plot_results_2D(X_t, y_t, l, name, clf, cvs):
+	import matplotlib.pyplot as plt
+	from matplotlib.colors import ListedColormap
 	# Create color maps
 	folder = "results_{0}".format(dataset_name)
 	if not os.path.exists(folder):
@@ -408,20 +1762,23 @@ def plot_results_2D(X_t, y_t, l, name, clf, cvs):
 	# Calculating prediction desicion mesh based on our algorithm
 	x_min, x_max = X_t[:, 0].min() - 0.01, X_t[:, 0].max() + 0.01
 	y_min, y_max = X_t[:, 1].min() - 0.01, X_t[:, 1].max() + 0.01
-	xx, yy = np.meshgrid(np.arange(x_min, x_max, 0.0001), np.arange(y_min, y_max, 0.0001))
-
-	Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
-	Z = Z.reshape(xx.shape)
+	key = fingerprint('surface', pickle.dumps(clf), x_min, x_max, y_min, y_max, SURFACE_RESOLUTION, SURFACE_REFINE)
+	surface = cache_get(key)
+	if surface is None:
+		with traced('decision_surface', 'surface', model=name):
+			surface = decision_surface(clf, x_min, x_max, y_min, y_max)
+		cache_put(key, surface)
+	x_edges, y_edges, Z = surface
 	
 	fig = plt.figure()
 	fig.suptitle(name + ' (mean_cvs = ' + str(cvs) + ')')
-	plt.xlim(xx.min(), xx.max())
-	plt.ylim(yy.min(), yy.max())
+	plt.xlim(x_min, x_max)
+	plt.ylim(y_min, y_max)
 	plt.xlabel(l[0])
 	plt.ylabel(l[1])	
 	
 	# Plotting prediction desicion mesh based on our algorithm
-	plt.pcolormesh(xx, yy, Z, cmap=cmap_light)
+	plt.imshow(Z, extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), origin='lower', aspect='auto', interpolation='nearest', cmap=cmap_light)
 	
 	# Plot testing points to check whether they are inside the predicted class 
 	plt.scatter(X_t[:,0],X_t[:,1], c=y_t, cmap=cmap_bold, edgecolor='k')
@@ -430,7 +1787,7 @@ def plot_results_2D(X_t, y_t, l, name, clf, cvs):
 	plt.savefig(("./{0}/{1}_{2}_{3}.png".format(folder, name, l[0].replace('/','-'), l[1].replace('/','-'))), bbox_inches='tight')
 	plt.close('all')
 
-def do_analyse(feature1, feature2, feature3):
+def do_analyse(feature1, feature2, feature3, tuned=None, pca=0, pca_solver='full'):
 	"""	
 	1) Analyze GaussianNB, SVC and KNN without adjusting their parameters 
 		- on all the features of the dataset
@@ -442,32 +1799,63 @@ def do_analyse(feature1, feature2, feature3):
 	4) Plot visualization of the predicted areas in 2-D space
 	5) Plot a comparison boxplot of the cross_val_scores of the results grouped by the algorithm
 	
+	tuned: parameters per (model, feature set), TUNED_PARAMS by default
+	pca: classify the first pca principal components instead of the chosen features
 	"""	
+	import matplotlib.pyplot as plt
+	from sklearn import metrics, model_selection
+	from sklearn.naive_bayes import GaussianNB
+	from sklearn.svm import SVC
 	folder = "results_{0}".format(dataset_name)
 	if not os.path.exists(folder):
 		os.makedirs(folder)
 
 	# Performing all the models without tuning on both 30 and 2 features and plotting box plots
 	
-	# prepare configuration for cross validation test harness
-	seed = 7
 	# prepare models
 	models = []
 	models.append(('NB', GaussianNB()))
 	models.append(('SVM', SVC(gamma='auto')))
-	models.append(('KNN', KNeighborsClassifier()))
+	models.append(('KNN', make_model('KNN', dict())))
+	# tuned models for all the features and for the chosen features
+	tuned = tuned or TUNED_PARAMS
+	tuned_models = []
+	for name in ['NB', 'SVC', 'KNN']:
+		tuned_models.append((name, make_model(name, tuned[(name, 'all')]), make_model(name, tuned[(name, 'chosen')])))
+
+	#for 30 features:
+	X, y = prepare_matrix()
+	#for 2 features, or the principal components:
+	columns = feature_columns(feature1, feature2, feature3)
+	if pca:
+		X_chosen, y_chosen, chosen_names = set_data_analyse_PCA(pca, pca_solver)
+	else:
+		X_chosen, y_chosen, chosen_names = set_data_analyse(feature1, feature2, feature3)
+	arrays = {'X': X, 'C': X_chosen, 'y': y}
+
+	# All (model, feature set, fold) cross-validation jobs are run as one graph on a process pool
+	jobs = []
+	for name, model in models:
+		jobs.append((('untuned', name, 'all'), 'X', model, 5))
+		jobs.append((('untuned', name, 'chosen'), 'C', model, 5))
+	for name, model_all, model_chosen in tuned_models:
+		jobs.append((('tuned', name, 'all'), 'X', model_all, 10))
+		jobs.append((('tuned', name, 'chosen'), 'C', model_chosen, 10))
+	# GaussianNB needs no fitting: its folds are scored straight from the class statistics
+	tasks = []
+	nb_scores = dict()
+	for key, matrix, model, n_splits in jobs:
+		if key[1] == 'NB' and model.priors is None:
+			nb_scores[key] = gnb_fold_scores(arrays[matrix], y, [None], n_splits, model.var_smoothing)[0]
+		else:
+			tasks.append((key, matrix, None, model, n_splits))
+	scores = run_cv_jobs(tasks, arrays)
+	scores.update(nb_scores)
 
 	# evaluate each model in turn
 	results1 = []
 	results2 = []
 	names = []
-	scoring = 'accuracy'
-	#for 30 features:
-	X = dataset.data
-	y = dataset.target
-	X = normalize(X, axis=0)
-	#for 2 features:
-	X2, y2, features = set_data_analyse(feature1, feature2, feature3)
 	
 	def set_box_color(bp, color):
 		plt.setp(bp['boxes'], color=color)
@@ -476,11 +1864,8 @@ def do_analyse(feature1, feature2, feature3):
 		plt.setp(bp['medians'], color=color)
 
 	for name, model in models:
-		kfold = model_selection.KFold(n_splits=5, random_state=seed)
-		cv_results1 = model_selection.cross_val_score(model, X, y, cv=kfold, scoring=scoring)
-		results1.append(cv_results1)
-		cv_results2 = model_selection.cross_val_score(model, X2, y2, cv=kfold, scoring=scoring)
-		results2.append(cv_results2)
+		results1.append(scores[('untuned', name, 'all')])
+		results2.append(scores[('untuned', name, 'chosen')])
 		names.append(name)
 
 	# Comparison box plot of NOT tuned algorithms
@@ -504,22 +1889,21 @@ def do_analyse(feature1, feature2, feature3):
 	results1 = []
 	results2 = []
 	names = []
+	fitted = dict()			# tuned models fitted on the training split, saved for serve.py
 
 
 	# Performing GaussianNB on all the features
 	print('/////////////////////////////////////////////')
 	print('Performing GaussianNB on all the features\n')
-	clf = GaussianNB()
-	X = dataset.data
-	y = dataset.target
-	X = normalize(X, axis=0)
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = model_selection.cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('NB', tuned[('NB', 'all')])
+	X, y = prepare_matrix()
+	cvs = scores[('tuned', 'NB', 'all')]
 	results1.append(cvs)
 	names.append('NB')
 
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
-	clf.fit(X_train,y_train)
+	clf = fit_cached(clf, X_train, y_train, dataset.feature_names)
+	fitted[('NB', 'all')] = (clf, None, np.mean(cvs), None)
 	y_pred = clf.predict(X_test)
 	print('GaussianNB score: ', metrics.f1_score(y_test,y_pred,average="macro"))
 	print('cross_val_score mean: ', np.mean(cvs))
@@ -528,20 +1912,18 @@ def do_analyse(feature1, feature2, feature3):
 	
 	# Performing Gaussian on two chosen features
 	print('/////////////////////////////////////////////')
-	print('Performing Gaussian on features:\n', feature1, '\n', feature2, '\n', feature3)
-	X, y, features = set_data_analyse(feature1, feature2, feature3)
-	#print('Performing Gaussian on', num_PCA, ' features from PCA\n')
-	#X, y = set_data_analyse_PCA(num_PCA)
+	print('Performing Gaussian on features:\n', '\n '.join(chosen_names))
+	X, y, features = X_chosen, y_chosen, chosen_names
 
 	classifier_name = 'GaussianNB'
-	clf = GaussianNB()
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('NB', tuned[('NB', 'chosen')])
+	cvs = scores[('tuned', 'NB', 'chosen')]
 	results2.append(cvs)
 
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
-	clf.fit(X_train, y_train)
-	if not feature3: 
+	clf = fit_cached(clf, X_train, y_train, features)
+	fitted[('NB', 'chosen')] = (clf, columns, np.mean(cvs), pca and (pca, pca_solver))
+	if len(features) == 2:
 		plot_results_2D(X_test, y_test, features, classifier_name, clf, np.mean(cvs))
 	y_pred = clf.predict(X_test)
 	print('GaussianNB on 2 features score: ', metrics.f1_score(y_test,y_pred,average="macro"))
@@ -554,17 +1936,15 @@ def do_analyse(feature1, feature2, feature3):
 	# Performing SVC on all the features
 	print('/////////////////////////////////////////////')
 	print('Performing SVC on all the features\n')
-	clf = SVC(C=100, kernel='rbf', gamma='scale')
-	X = dataset.data
-	y = dataset.target
-	X = normalize(X, axis=0)
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('SVC', tuned[('SVC', 'all')])
+	X, y = prepare_matrix()
+	cvs = scores[('tuned', 'SVC', 'all')]
 	results1.append(cvs)
 	names.append('SVC')
 	
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
-	clf.fit(X_train, y_train)
+	clf = fit_cached(clf, X_train, y_train, dataset.feature_names)
+	fitted[('SVC', 'all')] = (clf, None, np.mean(cvs), None)
 	y_pred = clf.predict(X_test)
 	#kfold = model_selection.KFold(n_splits=5, random_state=seed)
 	print('SVC score: ', metrics.f1_score(y_test,y_pred,average="macro"))
@@ -574,15 +1954,12 @@ def do_analyse(feature1, feature2, feature3):
 	
 	# Performing SVC on PCA two chosen features
 	print('/////////////////////////////////////////////')
-	print('Performing SVC on features:\n', feature1, '\n', feature2, '\n', feature3)
-	X, y, features = set_data_analyse(feature1, feature2, feature3)
-	#print('Performing SVC on', num_PCA, ' features from PCA\n')
-	#X, y = set_data_analyse_PCA(num_PCA)
+	print('Performing SVC on features:\n', '\n '.join(chosen_names))
+	X, y, features = X_chosen, y_chosen, chosen_names
 	
 	classifier_name = 'SVC'
-	clf = SVC(C=100, kernel='rbf', gamma='scale', random_state=None)
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = model_selection.cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('SVC', tuned[('SVC', 'chosen')])
+	cvs = scores[('tuned', 'SVC', 'chosen')]
 	results2.append(cvs)
 
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
@@ -594,8 +1971,9 @@ def do_analyse(feature1, feature2, feature3):
 	clf = clf.fit(X_train, y_train)
 	print("Best estimator found by grid search:")
 	print(clf.best_estimator_)'''
-	clf.fit(X_train, y_train)
-	if not feature3:
+	clf = fit_cached(clf, X_train, y_train, features)
+	fitted[('SVC', 'chosen')] = (clf, columns, np.mean(cvs), pca and (pca, pca_solver))
+	if len(features) == 2:
 		plot_results_2D(X_test, y_test, features, classifier_name, clf, np.mean(cvs))
 	y_pred = clf.predict(X_test)
 	print('SVC on 2 features score: ', metrics.f1_score(y_test,y_pred,average="macro"))
@@ -608,18 +1986,16 @@ def do_analyse(feature1, feature2, feature3):
 	# Performing KNeighborsClassifier on all the features
 	print('/////////////////////////////////////////////')
 	print('Performing KNeighborsClassifier on all the features\n')
-	clf = KNeighborsClassifier(n_neighbors=1, weights='uniform')
-	X = dataset.data
-	y = dataset.target
-	X = normalize(X, axis=0)
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = model_selection.cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('KNN', tuned[('KNN', 'all')])
+	X, y = prepare_matrix()
+	cvs = scores[('tuned', 'KNN', 'all')]
 	print('mean cvs: ', np.mean(cvs))
 	results1.append(cvs)
 	names.append('KNN')
 
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
-	clf.fit(X_train,y_train)
+	clf = fit_cached(clf, X_train, y_train, dataset.feature_names)
+	fitted[('KNN', 'all')] = (clf, None, np.mean(cvs), None)
 	y_pred = clf.predict(X_test)
 	'''for n in range(1,11):
 		clf = KNeighborsClassifier(n_neighbors=n).fit(X_train,y_train)
@@ -631,21 +2007,19 @@ def do_analyse(feature1, feature2, feature3):
 
 	# Performing KNeighborsClassifier for the two chosen columns
 	print('/////////////////////////////////////////////')
-	print('Performing KNN on features:\n', feature1, '\n', feature2, '\n', feature3)
-	X, y, features = set_data_analyse(feature1, feature2, feature3)
-	#print('Performing KNN on', num_PCA, ' features from PCA\n')
-	#X, y = set_data_analyse_PCA(num_PCA)
+	print('Performing KNN on features:\n', '\n '.join(chosen_names))
+	X, y, features = X_chosen, y_chosen, chosen_names
 
 	
 	classifier_name = 'KN'
-	clf = KNeighborsClassifier(n_neighbors=5, weights='uniform')
-	kfold = model_selection.KFold(n_splits=10, random_state=seed)
-	cvs = model_selection.cross_val_score(clf, X, y, cv=kfold, scoring=scoring)
+	clf = make_model('KNN', tuned[('KNN', 'chosen')])
+	cvs = scores[('tuned', 'KNN', 'chosen')]
 	results2.append(cvs)
 
 	X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.25, random_state=0)
-	clf.fit(X_train,y_train)
-	if not feature3:
+	clf = fit_cached(clf, X_train, y_train, features)
+	fitted[('KNN', 'chosen')] = (clf, columns, np.mean(cvs), pca and (pca, pca_solver))
+	if len(features) == 2:
 		plot_results_2D(X_test, y_test, features, classifier_name, clf, np.mean(cvs))
 	y_pred = clf.predict(X_test)
 	'''for n in range(1,11):
@@ -670,102 +2044,308 @@ def do_analyse(feature1, feature2, feature3):
 	#plt.hlines(m, xmin=-2, xmax=len(names)*2, colors='k', linestyles='solid', label='best score')
 	plt.xticks(range(0, len(names) * 2, 2), names)
 	plt.xlim(-2, len(names)*2)
-<<<<<<< HEAD
 	plt.ylim(0.3, 1)
-=======
-	#plt.ylim(0.3, 1)
->>>>>>> 995db5dc97939a6f3aa8ddd6576654549d39bc0c
 	plt.tight_layout()
 	plt.plot([], c='#2C7BB6', label='30 features')
 	plt.plot([], c='#D7191C', label='2 features')
 	plt.legend()
-	plt.title = 'Comparison of adjusted algorithms on 30 an 2 features'
+	plt.title('Comparison of adjusted algorithms on 30 an 2 features')
 	#plt.show()
 	plt.savefig(("./{0}/Comparison_optimized.png".format(folder)), bbox_inches='tight')
 	plt.close('all')
+	save_models(fitted)
+
+	# Mean fold scores of every model, combined over the datasets by a batch run
+	summary = [[tuning, name, feature_set, np.mean(cvs), np.std(cvs)] for (tuning, name, feature_set), cvs in sorted(scores.items())]
+	with open("./{0}/cv_scores.csv".format(folder), 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['tuning', 'model', 'features', 'mean_cvs', 'std_cvs'])
+		for r in summary:
+			writer.writerow(r[:3] + ['{0:.4f}'.format(r[3]), '{0:.4f}'.format(r[4])])
+	return summary
+
+def chosen_features():
+	'''Features used for the 2-D classification of each dataset'''
+	feature1 = dataset.feature_names[0]		# default pair for datasets loaded from files
+	feature2 = dataset.feature_names[1]
+	feature3 = ''
+	if dataset_name == 'iris':
+		feature1 = 'petal length (cm)'
+		feature2 = 'petal width (cm)'
+		feature3 = ''
+	if dataset_name == 'breast_cancer':
+		#feature1 = 'mean concave points'
+		#feature2 = 'mean perimeter'
+		#feature1 = 'mean texture'
+		#feature2 = 'mean symmetry'
+		feature1 = 'mean texture'
+		feature2 = 'worst smoothness'
+		feature3 = ''
+	if dataset_name == 'wine':
+		feature1 = 'od280/od315_of_diluted_wines'
+		feature2 = 'proline'
+		feature3 = ''
+	return feature1, feature2, feature3
+
+
+def check_features(features):
+	'''The --features names in the order given, padded to 3; an unknown name is a command line error'''
+	names = [str(name) for name in dataset.feature_names]
+	unknown = [name for name in features if name not in names]
+	if unknown:
+		arg_parser.error('Unknown features for {0}: {1}\nPossible features: \n{2}'.format(dataset_name, ', '.join(unknown), '\n'.join(names)))
+	return tuple(list(features) + [''] * (3 - len(features)))
+
+
+def run_stage(stage, func, folders, inputs, force=False):
+	'''Running a pipeline stage unless its manifest records the same inputs and its outputs still exist
+
+	The manifest (.<stage>.manifest.json in the first output folder) stores a hash of the inputs,
+	the inputs themselves and the files the stage wrote. Stages without output folders always run.
+	'''
+	key = fingerprint(stage, sorted(inputs.items()))
+	if not folders:
+		func()
+		return key
+	path = os.path.join(folders[0], '.{0}.manifest.json'.format(stage))
+	if not force and os.path.exists(path):
+		with open(path) as f:
+			manifest = json.load(f)
+		if manifest.get('key') == key and all(os.path.exists(name) for name in manifest['outputs']):
+			print('\n Stage {0} is up to date, skipping'.format(stage))
+			return key
+
+	start = time.time() - 1			# file systems with 1 s mtime resolution
+	func()
+	outputs = []
+	for folder in folders:
+		if os.path.exists(folder):
+			for name in sorted(os.listdir(folder)):
+				name = os.path.join(folder, name)
+				if not os.path.basename(name).startswith('.') and os.path.getmtime(name) >= start:
+					outputs.append(name)
+	if not os.path.exists(folders[0]):
+		os.makedirs(folders[0])
+	with open(path, 'w') as f:
+		json.dump(dict(stage=stage, key=key, inputs=inputs, outputs=outputs, finished=time.strftime('%Y-%m-%d %H:%M:%S')), f, indent=1)
+	return key
+
+
+def output_name(name):
+	'''Name of the output folders of a dataset: the dataset name, or the file name without extension'''
+	if os.path.isfile(name):
+		return os.path.splitext(os.path.basename(name))[0]
+	return name
+
+
+def run_dataset(name):
+	'''Running the selected stages on one dataset, returning its size'''
+	global dataset_name, dataset, classification_flag, normalized_data, column_norms, data_key
+
+	# Assigning dataset name to a local variable
+	stages = args.stages
+	dataset_name = output_name(name)		# output folders are named after the file
+	normalized_data = None					# a batch worker may have analysed another dataset before
+	column_norms = None
+	data_key = None
+	pca_projections.clear()
+	trace = args.trace
+	if trace and len(args.datasets) > 1:	# one trace per dataset
+		trace = '{0}_{2}{1}'.format(*os.path.splitext(trace), dataset_name)
+	if trace:
+		start_trace()
+
+	#Loading dataset from sklearn
+	with traced('load_data', 'load'):
+		dataset, classification_flag = load_data(name, args.target) 
+	print('Classification flag value: ', classification_flag)
+
+	# Transrferring sklearn dataset to Data Frame
+	with traced('read_data', 'load'):
+		data, grouped = read_data(dataset['data'], dataset['feature_names'], dataset['target'])
+	call_3d_clustering, mean_std, box, histograms, histograms_grouped, scatter_3d, scatter, scatter_new, corr = [trace_function(f) for f in all_functions(classification_flag, data, grouped)]
+
+	def plot_all_histograms():
+		print('\n Plotting all histograms into one figure')						#Plotting one histogram for all the features
+		histograms()
+		if classification_flag == True:
+			print('\n Plotting all histograms into one figure grouped by target')#Plotting one histogram for all the features grouped by diagnosis
+			histograms_grouped()
 
-#----------------------------------------------------------------------------------------------------------
-#----------------------------------------------------------------------------------------------------------
-#----------------------------------------------------------------------------------------------------------
-
-# Assigning dataset name to a local variable
-dataset_name = parser_assign()
-
-#Loading dataset from sklearn
-dataset, classification_flag = load_data(dataset_name) 
-print('Classification flag value: ', classification_flag)
-
-# Transrferring sklearn dataset to Data Frame
-data, grouped = read_data(dataset['data'], dataset['feature_names'], dataset['target'])
-call_3d_clustering, mean_std, box, histograms, histograms_grouped, scatter_3d, scatter, scatter_new, corr = all_functions(classification_flag, data, grouped) 
-
-# Calculating summary statistics
-mean_std()
-
-# Plotting histograms
-print('\n Plotting all histograms into one figure')						#Plotting one histogram for all the features
-histograms()
-if classification_flag == True:
-	print('\n Plotting all histograms into one figure grouped by target')#Plotting one histogram for all the features grouped by diagnosis
-	histograms_grouped()
-
-
-#Plotting Box plot
-print('\n Plotting box plots')
-box()
-
-
-# Plotting correlations heatmap
-print('\n Plotting correlation hitmap into /corr/ ')
-corr()	
-
-
-# Plotting scatter
-for i in range(len(data.iloc[0])-1):
-	j = 1
-	for j in range((i+j),len(data.iloc[0])-1):
-		col_name1 = data.iloc[:,i].name
-		col_name2 = data.iloc[:,j].name
-		print('\n Plotting scatter of ', col_name1, 'and ', col_name2)
-		scatter(col_name1, col_name2)
-		scatter_new(col_name1, col_name2)
+	def plot_box():
+		print('\n Plotting box plots')
+		box()
 
-	
-#Plotting 3D scatter and clustering for custom features
-if dataset_name == 'breast_cancer':
-	print('\n Plotting 3D scatters')
-	#scatter_3d('worst smoothness', 'mean texture', 'worst area')
-	scatter_3d('mean concave points', 'mean smoothness', 'mean compactness')
-	scatter_3d('mean concave points', 'mean perimeter', 'mean compactness')
-	print('\n Plotting 3D scatters with clustering')
-	#call_3d_clustering ('worst smoothness', 'mean texture', 'worst area')
-	call_3d_clustering ('mean concave points', 'mean smoothness', 'mean compactness')
-	call_3d_clustering ('mean concave points', 'mean perimeter', 'mean compactness')
-if dataset_name == 'boston':
-	print('\n Plotting 3D scatters')
-	scatter_3d('RM', 'LSTAT', 'DIS')
-
-
-#-----------CLASSIFICATION ANALYSIS-----------------------------------------
-num_PCA = 3 	# Set the number of culumns for PCA 
-
-if dataset_name == 'iris':
-	feature1 = 'petal length (cm)'
-	feature2 = 'petal width (cm)'
-	feature3 = ''
-if dataset_name == 'breast_cancer':
-	#feature1 = 'mean concave points'
-	#feature2 = 'mean perimeter'
-	#feature1 = 'mean texture'
-	#feature2 = 'mean symmetry'
-	feature1 = 'worst smoothness'
-	feature2 = 'mean texture'
-	feature3 = ''
-if dataset_name == 'wine':
-	feature1 = 'proline'
-	feature2 = 'od280/od315_of_diluted_wines'
-	feature3 = ''
-if classification_flag == True:
-	do_analyse(feature1, feature2, feature3)
+	def plot_corr():
+		print('\n Plotting correlation hitmap into /corr/ ')
+		corr(args.corr_cluster)
+
+	def plot_scatter():
+		pairs = []
+		for i in range(len(data.iloc[0])-1):
+			j = 1
+			for j in range((i+j),len(data.iloc[0])-1):
+				pairs.append((data.iloc[:,i].name, data.iloc[:,j].name))
+		render_scatter_pairs(pairs, [scatter, scatter_new], args.plot_workers)
+
+	def plot_3d():
+		#Plotting 3D scatter and clustering for custom features
+		if dataset_name == 'breast_cancer':
+			print('\n Plotting 3D scatters')
+			#scatter_3d('worst smoothness', 'mean texture', 'worst area')
+			scatter_3d('mean concave points', 'mean smoothness', 'mean compactness')
+			scatter_3d('mean concave points', 'mean perimeter', 'mean compactness')
+			print('\n Plotting 3D scatters with clustering')
+			#call_3d_clustering ('worst smoothness', 'mean texture', 'worst area')
+			call_3d_clustering ('mean concave points', 'mean smoothness', 'mean compactness')
+			call_3d_clustering ('mean concave points', 'mean perimeter', 'mean compactness')
+		if dataset_name == 'boston':
+			print('\n Plotting 3D scatters')
+			scatter_3d('RM', 'LSTAT', 'DIS')
+
+	#-----------CLASSIFICATION ANALYSIS-----------------------------------------
+	features = chosen_features()
+	if args.features:
+		features = check_features(args.features)
+
+	# Stage graph: load -> read_data -> stats/plots -> classification.
+	# Every stage depends on the loaded data; a stage reruns only when its inputs change.
+	data_key = fingerprint(dataset_name, np.asarray(dataset.data), np.asarray(dataset.target), [str(f) for f in dataset.feature_names])
+	pipeline = []
+	# stage, output folders, parameters, function
+	pipeline.append(('stats', [], dict(), mean_std))
+	pipeline.append(('hist', ['hist_{0}'], dict(bins=10), plot_all_histograms))
+	pipeline.append(('box', ['box_{0}'], dict(), plot_box))
+	pipeline.append(('corr', ['corr_{0}'], dict(cluster=args.corr_cluster), plot_corr))
+	pipeline.append(('scatter', ['scatter_{0}', 'scatter_{0}_new'], dict(density=len(data) > density_rows), plot_scatter))
+	pipeline.append(('3d', ['3D_{0}', 'scatter_{0}'], dict(density=len(data) > density_rows), plot_3d))
+	def classify():
+		tuned = None
+		if args.tune:
+			print('\n Searching the best parameters with successive halving')
+			if args.pca:
+				X_chosen = set_data_analyse_PCA(args.pca, args.pca_solver)[0]
+			else:
+				X_chosen = set_data_analyse(*features)[0]
+			tuned = tune_models(X_chosen)
+			if not os.path.exists("results_{0}".format(dataset_name)):
+				os.makedirs("results_{0}".format(dataset_name))
+			with open("./results_{0}/tuned_params.json".format(dataset_name), 'w') as f:
+				json.dump([dict(model=name, features=feature_set, params=params) for (name, feature_set), params in sorted(tuned.items())], f, indent=1)
+		do_analyse(*features, tuned=tuned, pca=args.pca, pca_solver=args.pca_solver)
 
+	if classification_flag == True:
+		pipeline.append(('classify', ['results_{0}'], dict(features=list(features), tune=args.tune, pca=args.pca, pca_solver=args.pca_solver, knn_backend=knn_backend), classify))
+		pipeline.append(('sweep', ['results_{0}'], dict(sizes=[2, 3], n_splits=10, knn_backend=knn_backend), sweep_subsets))
+		pipeline.append(('hyper', ['results_{0}'], dict(features=list(features), ks=list(range(1, 11)), Cs=[0.01, 0.1, 1, 10, 100, 1000], knn_backend=knn_backend), lambda: sweep_k_and_C(feature_columns(*features))))
 
+	try:
+		for stage, folders, params, func in pipeline:
+			if stage in stages:
+				with traced(stage, 'stage'):
+					run_stage(stage, func, [folder.format(dataset_name) for folder in folders], dict(data=data_key, params=params), args.force)
+	finally:
+		if trace:
+			write_trace(trace)
+	return dict(dataset=dataset_name, rows=np.shape(dataset.data)[0], features=np.shape(dataset.data)[1], classes=len(grouped.get("labels", [])))
+
+
+BATCH_LOGS = 'batch_logs'			# Output of every dataset of a batch run
+BATCH_SUMMARY = 'batch_summary.csv'
+
+WARM_MODULES = ['matplotlib.pyplot', 'plotly.offline', 'sklearn.datasets', 'sklearn.decomposition', 'sklearn.metrics', 'sklearn.model_selection',
+	'sklearn.naive_bayes', 'sklearn.neighbors', 'sklearn.preprocessing', 'sklearn.svm', 'neighbours']
+
+def warm_imports():
+	'''Importing the plotting and learning libraries once, so the batch workers forked afterwards share them'''
+	import importlib
+	for module in WARM_MODULES:
+		try:
+			importlib.import_module(module)
+		except ImportError:			# the stages that need it will report it
+			pass
+
+
+def run_batch_dataset(name):
+	'''Batch worker: running one dataset with its output written to batch_logs/<dataset>.log'''
+	import traceback
+	start = time.time()
+	with open(os.path.join(BATCH_LOGS, output_name(name) + '.log'), 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+		try:
+			summary = run_dataset(name)
+			summary['status'] = 'ok'
+		except Exception as e:			# one failing dataset does not stop the others
+			traceback.print_exc()
+			summary = dict(dataset=output_name(name), status='failed: {0}'.format((str(e).splitlines() or [type(e).__name__])[0]))
+		except SystemExit:				# a command line error found after loading, reported in the log
+			summary = dict(dataset=output_name(name), status='failed: invalid arguments, see {0}'.format(f.name))
+	summary['seconds'] = time.time() - start
+	return summary
+
+
+def run_batch(names, workers=None):
+	'''Analysing several datasets concurrently on a process pool and writing the combined cross-validation scores'''
+	global n_jobs
+	from concurrent.futures import as_completed
+	workers = max(1, min(len(names), workers or os.cpu_count() or 1))
+	if n_jobs is None:			# the cores are shared by the datasets analysed at the same time
+		n_jobs = max(1, (os.cpu_count() or 1) // workers)
+	if not os.path.exists(BATCH_LOGS):
+		os.makedirs(BATCH_LOGS)
+	warm_imports()
+
+	print('\n Analysing {0} datasets on {1} workers, logs in {2}/'.format(len(names), workers, BATCH_LOGS))
+	results = dict()
+	with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+		futures = {pool.submit(run_batch_dataset, name): name for name in names}
+		for future in as_completed(futures):
+			summary = future.result()
+			results[futures[future]] = summary
+			print(' {0:<16} {1} in {2:.1f} s'.format(summary['dataset'], summary['status'], summary['seconds']))
+
+	# Combined table: one row per dataset and model, read from the cv_scores.csv of each results folder
+	rows = []
+	for name in names:
+		summary = results[name]
+		info = [summary['dataset'], summary['status'], '{0:.1f}'.format(summary['seconds']), summary.get('rows', ''), summary.get('features', ''), summary.get('classes', '')]
+		path = os.path.join("results_{0}".format(summary['dataset']), 'cv_scores.csv')
+		if summary['status'] == 'ok' and os.path.exists(path):
+			with open(path, newline='') as f:
+				for r in csv.DictReader(f):
+					rows.append(info + [r['tuning'], r['model'], r['features'], r['mean_cvs'], r['std_cvs']])
+		else:
+			rows.append(info + [''] * 5)
+	with open(BATCH_SUMMARY, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['dataset', 'status', 'seconds', 'rows', 'features', 'classes', 'tuning', 'model', 'feature_set', 'mean_cvs', 'std_cvs'])
+		writer.writerows(rows)
+
+	print('\n Tuned cross_val_score means (all features / chosen features):')
+	means = {(r[0], r[7], r[8]): r[9] for r in rows if r[6] == 'tuned'}
+	for name in names:
+		summary = results[name]
+		models = [model for (dataset, model, feature_set) in means if dataset == summary['dataset'] and feature_set == 'all']
+		scores = ['{0} {1}/{2}'.format(model, means[(summary['dataset'], model, 'all')], means.get((summary['dataset'], model, 'chosen'), '-')) for model in models]
+		print(' {0:<16} {1}'.format(summary['dataset'], '   '.join(scores) or summary['status']))
+	print('\n Summary written to {0}'.format(BATCH_SUMMARY))
+	return rows
+
+
+def main(argv=None):
+	'''Running the selected stages on one dataset, or on several of them concurrently'''
+	global args, n_jobs, cache_dir, cache_max_bytes, knn_backend, density_rows
+
+	args = parser_assign(argv)
+	n_jobs = args.jobs
+	knn_backend = args.knn_backend
+	density_rows = args.density_rows
+	cache_dir = None if args.no_cache else args.cache_dir
+	cache_max_bytes = args.cache_size * 2**20
+	if len(args.datasets) == 1:
+		run_dataset(args.datasets[0])
+	else:
+		run_batch(args.datasets, args.batch_workers)
+
+
+if __name__ == '__main__':
+	main()
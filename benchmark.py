@@ -0,0 +1,229 @@
+'''Timing and peak memory of the analyse.py stages on synthetic datasets of growing size
+
+Every (rows, features) case generates a classification dataset shaped like the sklearn loaders,
+sets the globals of analyse.py and measures read_data, find_mean_std, plot_corr, the scatter loop,
+the cross-validation of each model in do_analyse and plot_results_2D. Results are written as JSON
+tagged with the git revision, so runs of two commits can be compared with --compare.
+'''
+import numpy as np
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import analyse
+
+STAGES = ['read_data', 'find_mean_std', 'plot_corr', 'scatter', 'cv', 'plot_results_2D']
+
+
+def parser_assign(argv=None):
+	'''Benchmark options'''
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='numbers of rows')
+	parser.add_argument('--features', type=int, nargs='+', default=[10, 50, 500], help='numbers of features')
+	parser.add_argument('--classes', type=int, default=2)
+	parser.add_argument('--max-cells', type=float, default=1e8, help='skip cases with more rows*features than this')
+	parser.add_argument('--model-rows', type=int, default=20000, help='rows used for the models (SVC is quadratic in the rows)')
+	parser.add_argument('--pairs', type=int, default=20, help='feature pairs drawn by the scatter loop')
+	parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to measure: ' + ', '.join(STAGES))
+	parser.add_argument('--jobs', type=int, default=1, help='worker processes for cross-validation (memory of the workers is not traced)')
+	parser.add_argument('--no-memory', action='store_true', help='time only, without tracemalloc (which slows allocations down)')
+	parser.add_argument('--output', default=None, help='JSON file, benchmark_<revision>.json by default')
+	parser.add_argument('--compare', default=None, help='earlier JSON file to compare the results with')
+	parser.add_argument('--verbose', action='store_true', help='keep the output of analyse.py')
+	args = parser.parse_args(argv)
+	args.stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+	unknown = set(args.stages) - set(STAGES)
+	if unknown:
+		parser.error('unknown stages: {0}'.format(', '.join(sorted(unknown))))
+	return args
+
+
+def git_revision():
+	'''Current commit and whether tracked files differ from it'''
+	here = os.path.dirname(os.path.abspath(__file__))
+	try:
+		rev = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+		dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, capture_output=True, text=True, check=True).stdout.strip() != ''
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown', False
+	return rev, dirty
+
+
+def synthetic_dataset(rows, features, classes=2, seed=0, chunk_rows=100000):
+	'''Classification data shaped like the sklearn loaders (data, target, feature_names, target_names)
+
+	The first min(features, 5) features are informative: their class means differ by about one standard
+	deviation. Values are positive like the measurements of the toy datasets and stored as float32.
+	'''
+	from sklearn.utils import Bunch
+	rng = np.random.RandomState(seed)
+	informative = min(features, 5)
+	centers = np.zeros((classes, features), dtype=np.float32)
+	centers[:, :informative] = rng.normal(size=(classes, informative))
+	scales = rng.uniform(0.5, 5, size=features).astype(np.float32)
+	target = rng.randint(classes, size=rows)
+	data = np.empty((rows, features), dtype=np.float32)
+	for start in range(0, rows, chunk_rows):
+		stop = min(rows, start + chunk_rows)
+		block = rng.standard_normal((stop - start, features)).astype(np.float32)
+		block += centers[target[start:stop]]
+		data[start:stop] = (block + 6) * scales
+	return Bunch(
+		data = data,
+		target = target,
+		feature_names = np.array(['feature {0}'.format(j) for j in range(features)]),
+		target_names = np.array(['class {0}'.format(c) for c in range(classes)]),
+		DESCR = 'synthetic {0}x{1}'.format(rows, features)
+	)
+
+
+def measure(func, memory=True):
+	'''Wall time, CPU time and peak traced allocation of one call'''
+	gc.collect()
+	if memory:
+		tracemalloc.start()
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	result = func()
+	entry = dict(seconds = time.perf_counter() - wall, cpu_seconds = time.process_time() - cpu)
+	if memory:
+		entry['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return entry, result
+
+
+def cross_validate(name, model, X, y, columns, n_splits):
+	'''Fold scores of one model the way do_analyse computes them'''
+	if name == 'NB' and model.priors is None:
+		return analyse.gnb_fold_scores(X, y, [columns], n_splits, model.var_smoothing)[0]
+	return analyse.run_cv_jobs([(name, 'X', columns, model, n_splits)], {'X': X, 'y': y})[name]
+
+
+def run_case(rows, features, args):
+	'''Measuring every selected stage on one synthetic dataset'''
+	from sklearn import model_selection
+	results = []
+	def record(stage, func, **extra):
+		entry, result = measure(func, not args.no_memory)
+		entry.update(dict(rows=rows, features=features, stage=stage), **extra)
+		results.append(entry)
+		print(' {0:>8} x {1:<4} {2:<24} {3:9.3f} s{4}'.format(rows, features, stage, entry['seconds'],
+			'  {0:9.1f} MB'.format(entry['peak_bytes'] / 2**20) if 'peak_bytes' in entry else ''), file=sys.__stdout__)
+		return result
+
+	dataset = synthetic_dataset(rows, features, args.classes)
+	analyse.dataset_name = 'synthetic_{0}x{1}'.format(rows, features)
+	analyse.dataset = dataset
+	analyse.classification_flag = True
+	analyse.normalized_data = None
+
+	data, grouped = record('read_data', lambda: analyse.read_data(dataset['data'], dataset['feature_names'], dataset['target']))
+	functions = analyse.all_functions(True, data, grouped)
+	mean_std, scatter, scatter_new, corr = functions[1], functions[6], functions[7], functions[8]
+	if 'find_mean_std' in args.stages:
+		record('find_mean_std', mean_std)
+	if 'plot_corr' in args.stages:
+		record('plot_corr', corr)
+	if 'scatter' in args.stages:
+		names = list(data.columns[:-1])
+		pairs = [(names[i], names[j]) for i in range(len(names)) for j in range(i + 1, len(names))][:args.pairs]
+		record('scatter', lambda: analyse.render_scatter_pairs(pairs, [scatter, scatter_new], 1), pairs=len(pairs))
+
+	if 'cv' in args.stages or 'plot_results_2D' in args.stages:
+		X, y = analyse.prepare_matrix()
+		m = min(rows, args.model_rows)
+		X, y = X[:m], y[:m]
+		columns = [0, 1]
+		for name in ['NB', 'SVC', 'KNN']:
+			model_all = analyse.make_model(name, analyse.TUNED_PARAMS[(name, 'all')])
+			model_chosen = analyse.make_model(name, analyse.TUNED_PARAMS[(name, 'chosen')])
+			if 'cv' in args.stages:
+				record('cv {0} all'.format(name), lambda: cross_validate(name, model_all, X, y, None, 10), model_rows=m)
+				record('cv {0} chosen'.format(name), lambda: cross_validate(name, model_chosen, X, y, columns, 10), model_rows=m)
+			if 'plot_results_2D' in args.stages:
+				X_train, X_test, y_train, y_test = model_selection.train_test_split(X[:, columns], y, test_size=0.2, random_state=0)
+				clf = model_chosen.fit(X_train, y_train)
+				l = [str(dataset.feature_names[j]) for j in columns]
+				record('plot_results_2D {0}'.format(name), lambda: analyse.plot_results_2D(X_test, y_test, l, name, clf, 0), model_rows=m)
+	analyse.normalized_data = None
+	return results
+
+
+def compare(base, results):
+	'''Printing the time and memory ratios against an earlier run'''
+	previous = {(r['rows'], r['features'], r['stage']): r for r in base['results']}
+	print('\n Compared with {0}{1}'.format(base['revision'][:10], ' (dirty)' if base.get('dirty') else ''))
+	print(' {0:>8}   {1:<4} {2:<24} {3:>9} {4:>9} {5:>7} {6:>7}'.format('rows', 'feat', 'stage', 'before s', 'after s', 'time', 'memory'))
+	for r in results:
+		old = previous.get((r['rows'], r['features'], r['stage']))
+		if old is None:
+			continue
+		memory = ''
+		if old.get('peak_bytes') and 'peak_bytes' in r:
+			memory = '{0:6.2f}x'.format(r['peak_bytes'] / old['peak_bytes'])
+		print(' {0:>8} x {1:<4} {2:<24} {3:9.3f} {4:9.3f} {5:6.2f}x {6:>7}'.format(r['rows'], r['features'], r['stage'], old['seconds'], r['seconds'], r['seconds'] / max(old['seconds'], 1e-9), memory))
+
+
+def main(argv=None):
+	'''Running the benchmark grid and writing the JSON report'''
+	args = parser_assign(argv)
+	rev, dirty = git_revision()
+	output = os.path.abspath(args.output or 'benchmark_{0}.json'.format(rev[:10]))
+	base = None
+	if args.compare:
+		with open(args.compare) as f:
+			base = json.load(f)
+
+	import matplotlib
+	matplotlib.use('Agg')
+	analyse.n_jobs = args.jobs
+	analyse.cache_dir = None			# every stage is measured without the persistent cache
+
+	results = []
+	cwd = os.getcwd()
+	quiet = open(os.devnull, 'w')
+	workdir = tempfile.mkdtemp(prefix='analyse_benchmark_')		# plots are written here and removed
+	os.chdir(workdir)
+	try:
+		for rows in args.rows:
+			for features in args.features:
+				if rows * features > args.max_cells:
+					print(' {0:>8} x {1:<4} skipped (more than {2:g} cells)'.format(rows, features, args.max_cells))
+					continue
+				with contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+					results.extend(run_case(rows, features, args))
+	finally:
+		os.chdir(cwd)
+		quiet.close()
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	report = dict(
+		revision = rev,
+		dirty = dirty,
+		date = time.strftime('%Y-%m-%d %H:%M:%S'),
+		python = platform.python_version(),
+		numpy = np.__version__,
+		machine = platform.machine(),
+		cpus = os.cpu_count(),
+		settings = dict(classes=args.classes, model_rows=args.model_rows, pairs=args.pairs, jobs=args.jobs, memory=not args.no_memory),
+		results = results
+	)
+	with open(output, 'w') as f:
+		json.dump(report, f, indent=1)
+	print('\n Results written to {0}'.format(output))
+	if base is not None:
+		compare(base, results)
+	return report
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,92 @@
+'''Checking the vectorised fold scores of analyse.py against sklearn's cross_val_score
+
+gnb_fold_scores replaces the GaussianNB fits of the sweep with one tensor pass over the folds, and
+score_k_and_C the KNN and SVC fits of the hyper stage with shared distance and kernel matrices.
+Both have to give the same fold accuracies as cross_val_score with KFold, so a change of sklearn's
+estimators (smoothing, gamma='scale', tie breaking) shows up here. Exits with status 1 on any mismatch.
+'''
+import numpy as np
+import argparse
+import itertools
+import sys
+
+from sklearn import datasets, model_selection
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.svm import SVC
+
+import analyse
+
+DATASETS = ['iris', 'wine', 'breast_cancer']
+KS = range(1, 11)
+CS = (0.01, 0.1, 1, 10, 100, 1000)
+TOLERANCE = 1e-9		# fold accuracies are ratios of counts, any real difference is at least 1/len(test)
+
+
+def parser_assign(argv=None):
+	'''Check options'''
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('datasets', nargs='*', help='sklearn datasets to check: ' + ', '.join(DATASETS) + ' (all by default)')
+	parser.add_argument('--folds', type=int, default=10, help='number of KFold splits')
+	parser.add_argument('--subsets', type=int, default=20, help='feature pairs checked per dataset, besides all the features')
+	parser.add_argument('--backends', nargs='+', default=['brute', 'kd_tree', 'ball_tree'], choices=['brute', 'kd_tree', 'ball_tree'], help='exact neighbour searches checked with score_k_and_C')
+	args = parser.parse_args(argv)
+	args.datasets = args.datasets or DATASETS
+	unknown = set(args.datasets) - set(DATASETS)
+	if unknown:
+		parser.error('unknown datasets: {0}'.format(', '.join(sorted(unknown))))
+	return args
+
+
+def reference(model, X, y, n_splits):
+	'''Fold accuracies of sklearn itself'''
+	return model_selection.cross_val_score(model, X, y, cv=model_selection.KFold(n_splits=n_splits), scoring='accuracy')
+
+
+def compare(label, ours, theirs):
+	'''Printing one check, True when the fold accuracies agree'''
+	ok = np.allclose(ours, theirs, rtol=0, atol=TOLERANCE)
+	print(' {0:<40} {1}'.format(label, 'ok' if ok else 'MISMATCH\n   ours:    {0}\n   sklearn: {1}'.format(np.round(ours, 4), np.round(theirs, 4))))
+	return ok
+
+
+def check_gnb(X, y, n_subsets, n_splits):
+	'''gnb_fold_scores on all the features and on the first feature pairs'''
+	ok = compare('GaussianNB, all features', analyse.gnb_fold_scores(X, y, [None], n_splits)[0], reference(GaussianNB(), X, y, n_splits))
+	pairs = list(itertools.islice(itertools.combinations(range(X.shape[1]), 2), n_subsets))
+	for columns, ours in zip(pairs, analyse.gnb_fold_scores(X, y, pairs, n_splits)):
+		ok &= compare('GaussianNB, features {0}'.format(columns), ours, reference(GaussianNB(), X[:, list(columns)], y, n_splits))
+	return ok
+
+
+def check_k_and_C(X, y, backends, n_splits):
+	'''score_k_and_C for every k of KNN and every C of the RBF SVC, with each neighbour search
+
+	Each backend is checked against KNeighborsClassifier with the same algorithm: equally distant
+	neighbours (duplicate rows of iris) are ordered differently by the trees and brute force.
+	'''
+	ok = True
+	for backend in backends:
+		knn_scores, svc_scores = analyse.score_k_and_C(X, y, KS, CS, n_splits, backend)
+		for k, ours in zip(KS, knn_scores):
+			ok &= compare('KNN k={0} ({1})'.format(k, backend), ours, reference(KNeighborsClassifier(n_neighbors=k, algorithm=backend), X, y, n_splits))
+	for C, ours in zip(CS, svc_scores):
+		ok &= compare('SVC C={0}'.format(C), ours, reference(SVC(C=C, kernel='rbf', gamma='scale'), X, y, n_splits))
+	return ok
+
+
+def main(argv=None):
+	args = parser_assign(argv)
+	ok = True
+	for name in args.datasets:
+		data = getattr(datasets, 'load_' + name)()
+		X, y = np.asarray(data.data, dtype=np.float64), data.target
+		print('\n {0}: {1} rows, {2} features, {3} folds'.format(name, X.shape[0], X.shape[1], args.folds))
+		ok &= check_gnb(X, y, args.subsets, args.folds)
+		ok &= check_k_and_C(X, y, args.backends, args.folds)
+	print('\n {0}'.format('All scores match sklearn' if ok else 'Some scores differ from sklearn'))
+	return 0 if ok else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,108 @@
+'''Load generator for serve.py: concurrent keep-alive clients posting rows drawn from the dataset
+
+Prints the client-side p50/p99 latency and throughput, then the statistics reported by the server.
+'''
+import numpy as np
+import argparse
+import asyncio
+import json
+import time
+
+
+def parser_assign(argv=None):
+	'''Load options'''
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--host", default='127.0.0.1')
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--model", default='SVC/all', help="model to query, as listed by GET /models")
+	parser.add_argument("--data", default=None, help="dataset name or CSV/Parquet path to draw rows from (default: the served dataset)")
+	parser.add_argument("--concurrency", type=int, default=32, help="number of simultaneous connections")
+	parser.add_argument("--requests", type=int, default=5000, help="total number of requests")
+	parser.add_argument("--rows", type=int, default=1, help="rows per request")
+	parser.add_argument("--seed", type=int, default=0)
+	return parser.parse_args(argv)
+
+
+async def request(reader, writer, method, path, payload=None):
+	'''Sending one request on a keep-alive connection and reading the JSON response'''
+	body = b'' if payload is None else json.dumps(payload).encode()
+	writer.write('{0} {1} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n'.format(method, path, len(body)).encode() + body)
+	await writer.drain()
+	status = int((await reader.readline()).split()[1])
+	length = 0
+	while True:
+		header = await reader.readline()
+		if header in (b'\r\n', b'\n', b''):
+			break
+		name, _, value = header.decode('latin-1').partition(':')
+		if name.strip().lower() == 'content-length':
+			length = int(value)
+	return status, json.loads(await reader.readexactly(length))
+
+
+async def fetch(host, port, path):
+	'''One GET request on a new connection'''
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		return await request(reader, writer, 'GET', path)
+	finally:
+		writer.close()
+
+
+def sample_rows(data, features, n, seed):
+	'''Raw rows of the served features, drawn from the dataset'''
+	import analyse
+	dataset, _ = analyse.load_data(data)
+	names = [str(name) for name in dataset.feature_names]
+	columns = [names.index(name) for name in features]
+	X = np.asarray(dataset.data)[:, columns]
+	return X[np.random.RandomState(seed).randint(len(X), size=n)]
+
+
+async def client(args, payloads, latencies, errors):
+	'''One connection sending its share of the requests one after another'''
+	reader, writer = await asyncio.open_connection(args.host, args.port)
+	try:
+		for payload in payloads:
+			start = time.perf_counter()
+			status, _ = await request(reader, writer, 'POST', '/predict/' + args.model, payload)
+			latencies.append(time.perf_counter() - start)
+			if status != 200:
+				errors.append(status)
+	finally:
+		writer.close()
+
+
+async def run(args):
+	'''Generating the load and printing the client and server statistics'''
+	_, info = await fetch(args.host, args.port, '/models')
+	if args.model not in info['models']:
+		raise SystemExit('Unknown model {0}, served models: {1}'.format(args.model, ', '.join(sorted(info['models']))))
+	features = info['models'][args.model]['features']
+	rows = sample_rows(args.data or info['dataset'], features, args.requests * args.rows, args.seed)
+	payloads = [dict(rows=rows[i:i + args.rows].tolist()) for i in range(0, len(rows), args.rows)]
+
+	latencies = []
+	errors = []
+	start = time.perf_counter()
+	await asyncio.gather(*[client(args, payloads[i::args.concurrency], latencies, errors) for i in range(args.concurrency)])
+	elapsed = time.perf_counter() - start
+
+	latencies = np.array(latencies) * 1e3
+	print('\n {0} requests of {1} rows to /predict/{2} over {3} connections in {4:.2f} s'.format(len(latencies), args.rows, args.model, args.concurrency, elapsed))
+	print(' throughput: {0:.1f} requests/s, {1:.1f} rows/s'.format(len(latencies) / elapsed, len(latencies) * args.rows / elapsed))
+	print(' latency: p50 {0:.3f} ms, p99 {1:.3f} ms, max {2:.3f} ms'.format(np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()))
+	if errors:
+		print(' {0} failed requests (status {1})'.format(len(errors), ', '.join(str(s) for s in sorted(set(errors)))))
+	_, stats = await fetch(args.host, args.port, '/stats')
+	print(' server: ' + json.dumps(stats))
+
+
+def main(argv=None):
+	'''Running the load generator'''
+	args = parser_assign(argv)
+	asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,149 @@
+'''Nearest-neighbour search backends for the KNN models of analyse.py
+
+Exact search is done by sklearn (brute force, KD-tree or ball tree). The 'lsh' backend is an
+approximate index of binary random-projection codes for data with many features; queries only
+compute exact distances to the training rows whose codes are nearest to theirs.
+'''
+import numpy as np
+import time
+
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+QUERY_CHUNK_CELLS = 1 << 22		# Upper bound on the queries*rows*words (or features) of one distance block
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)		# set bits of every byte
+
+
+def popcount(words):
+	'''Set bits of every uint64, summed over the last axis'''
+	if hasattr(np, 'bitwise_count'):			# numpy >= 2.0
+		return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+	return POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+class RandomProjectionIndex(object):
+	'''Approximate neighbour index: every row is coded by the sides of n_bits random hyperplanes
+
+	Every hyperplane passes through a random training row, so nearby rows share most of their bits.
+	A query ranks the training rows by the Hamming distance of their codes (sign-random-projection LSH)
+	and only the n_candidates * k nearest codes are ranked by their exact distances.
+	Training sets with no more rows than that are searched exactly.
+	'''
+	def __init__(self, X, n_bits=64, n_candidates=8, random_state=0):
+		self.X = np.asarray(X, dtype=np.float64)
+		n, n_features = self.X.shape
+		rng = np.random.RandomState(random_state)
+		self.planes = rng.standard_normal((n_features, n_bits))
+		self.offsets = np.einsum('bf,fb->b', self.X[rng.randint(n, size=n_bits)], self.planes)
+		self.n_candidates = n_candidates
+		self.codes = self.hash(self.X)
+
+	def hash(self, X):
+		'''Binary codes of the rows of X packed into uint64 words'''
+		bits = X @ self.planes > self.offsets
+		bits = np.pad(bits, ((0, 0), (0, -bits.shape[1] % 64)))
+		return np.ascontiguousarray(np.packbits(bits, axis=1)).view(np.uint64)
+
+	def approximate(self, k):
+		'''Whether queries for k neighbours skip part of the training rows'''
+		return self.n_candidates * k < len(self.X)
+
+	def exact_kneighbors(self, Q, k):
+		'''Squared distances and indices of the k nearest training rows by brute force'''
+		dist = np.empty((len(Q), k))
+		ind = np.empty((len(Q), k), dtype=np.intp)
+		sq = (self.X**2).sum(axis=1)
+		chunk = max(1, QUERY_CHUNK_CELLS // len(self.X))
+		for a in range(0, len(Q), chunk):
+			q = Q[a:a+chunk]
+			d = np.maximum((q**2).sum(axis=1)[:, None] - 2 * (q @ self.X.T) + sq, 0)
+			best = np.argpartition(d, k - 1, axis=1)[:, :k] if k < d.shape[1] else np.broadcast_to(np.arange(k), d.shape).copy()
+			best = np.take_along_axis(best, np.argsort(np.take_along_axis(d, best, axis=1), axis=1, kind='stable'), axis=1)
+			dist[a:a+chunk] = np.take_along_axis(d, best, axis=1)
+			ind[a:a+chunk] = best
+		return dist, ind
+
+	def kneighbors(self, Q, n_neighbors=5):
+		'''Approximate euclidean distances and indices of the n_neighbors nearest training rows, nearest first'''
+		Q = np.asarray(Q, dtype=np.float64)
+		k = min(n_neighbors, len(self.X))
+		if not self.approximate(k):
+			dist, ind = self.exact_kneighbors(Q, k)
+			return np.sqrt(dist), ind
+		m = self.n_candidates * k
+		dist = np.empty((len(Q), k))
+		ind = np.empty((len(Q), k), dtype=np.intp)
+		chunk = max(1, QUERY_CHUNK_CELLS // max(len(self.X) * self.codes.shape[1], m * self.X.shape[1]))
+		for a in range(0, len(Q), chunk):
+			q = Q[a:a+chunk]
+			hamming = popcount(self.hash(q)[:, None, :] ^ self.codes[None])		# (queries, rows)
+			cand = np.argpartition(hamming, m - 1, axis=1)[:, :m]
+			d = ((self.X[cand] - q[:, None, :])**2).sum(axis=2)
+			best = np.argpartition(d, k - 1, axis=1)[:, :k]
+			best = np.take_along_axis(best, np.argsort(np.take_along_axis(d, best, axis=1), axis=1, kind='stable'), axis=1)
+			dist[a:a+chunk] = np.take_along_axis(d, best, axis=1)
+			ind[a:a+chunk] = np.take_along_axis(cand, best, axis=1)
+		return np.sqrt(dist), ind
+
+
+class LSHNeighborsClassifier(BaseEstimator, ClassifierMixin):
+	'''KNN classifier on a RandomProjectionIndex, with the votes of sklearn's KNeighborsClassifier'''
+	def __init__(self, n_neighbors=5, weights='uniform', n_bits=64, n_candidates=8, random_state=0):
+		self.n_neighbors = n_neighbors
+		self.weights = weights
+		self.n_bits = n_bits
+		self.n_candidates = n_candidates
+		self.random_state = random_state
+
+	def fit(self, X, y):
+		self.classes_, self._codes = np.unique(y, return_inverse=True)
+		self.index_ = RandomProjectionIndex(X, self.n_bits, self.n_candidates, self.random_state)
+		return self
+
+	def kneighbors(self, X, n_neighbors=None):
+		return self.index_.kneighbors(X, n_neighbors or self.n_neighbors)
+
+	def predict(self, X):
+		dist, ind = self.kneighbors(X)
+		if self.weights == 'distance':
+			with np.errstate(divide='ignore'):
+				w = 1.0 / dist
+			exact = np.isinf(w)
+			w = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), w)		# zero distance: only those rows vote
+		else:
+			w = np.ones(dist.shape)
+		votes = np.zeros((len(ind), len(self.classes_)))
+		np.add.at(votes, (np.arange(len(ind))[:, None], self._codes[ind]), w)
+		return self.classes_[votes.argmax(axis=1)]
+
+
+def build_index(X, backend, random_state=0):
+	'''Neighbour index over the rows of X with a kneighbors(Q, n_neighbors) method'''
+	if backend == 'lsh':
+		return RandomProjectionIndex(X, random_state=random_state)
+	from sklearn.neighbors import NearestNeighbors
+	return NearestNeighbors(algorithm=backend).fit(X)
+
+
+def compare_backends(X_train, X_query, k=10, backends=('kd_tree', 'ball_tree', 'lsh')):
+	'''Build and query time, speed-up and recall@k of each backend against exact brute-force search
+
+	Recall counts the returned neighbours that are no farther than the exact k-th neighbour,
+	so ties in the exact ranking are not counted as misses. approximate is False for the LSH
+	index when the training set is small enough to be searched exactly.
+	'''
+	k = min(k, len(X_train))
+	start = time.perf_counter()
+	exact, _ = build_index(X_train, 'brute').kneighbors(X_query, k)
+	exact_time = time.perf_counter() - start
+	limit = exact[:, -1:] * (1 + 1e-9) + 1e-12
+	rows = [dict(backend='brute', build_s=0.0, query_s=exact_time, speedup=1.0, recall=1.0, approximate=False)]
+	for backend in backends:
+		start = time.perf_counter()
+		index = build_index(X_train, backend)
+		built = time.perf_counter()
+		dist, _ = index.kneighbors(X_query, k)
+		done = time.perf_counter()
+		rows.append(dict(backend=backend, build_s=built - start, query_s=done - built,
+			speedup=exact_time / max(done - start, 1e-12), recall=float(np.mean(dist <= limit)),
+			approximate=backend == 'lsh' and index.approximate(k)))
+	return rows
@@ -0,0 +1,252 @@
+'''Serving the tuned models saved by analyse.py (results_<dataset>/models.pkl) on a local HTTP endpoint
+
+POST /predict/<model>/<all|chosen>  {"rows": [[...], ...]} raw feature values, in the order given by GET /models
+GET  /models                        models, their features and mean cross-validation scores
+GET  /stats                         latency percentiles, throughput and batch sizes
+Concurrent requests for the same model are merged into micro-batches, so every predict call is vectorized.
+'''
+import numpy as np
+import argparse
+import asyncio
+import collections
+import json
+import os
+import pickle
+import time
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def parser_assign(argv=None):
+	'''Server options'''
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("models", nargs='?', default=None, help="models.pkl written by analyse.py (default: results_<dataset>/models.pkl)")
+	parser.add_argument("--dataset", default='breast_cancer', help="dataset whose results folder holds models.pkl")
+	parser.add_argument("--host", default='127.0.0.1')
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--max-batch", type=int, default=256, help="most rows merged into one predict call (1 disables batching)")
+	parser.add_argument("--max-delay", type=float, default=2.0, help="milliseconds a batch waits for more requests")
+	parser.add_argument("--report-every", type=float, default=10.0, help="seconds between statistics reports, 0 for none")
+	args = parser.parse_args(argv)
+	if args.models is None:
+		args.models = os.path.join("results_{0}".format(args.dataset), 'models.pkl')
+	return args
+
+
+def load_models(path):
+	'''Reading the fitted models, features and column norms saved by analyse.save_models'''
+	with open(path, 'rb') as f:
+		return pickle.load(f)
+
+
+class LatencyStats(object):
+	'''Latencies of the recent requests, request and row counts, and batch sizes'''
+	def __init__(self, window=100000):
+		self.latencies = collections.deque(maxlen=window)
+		self.batches = collections.deque(maxlen=window)
+		self.requests = 0
+		self.rows = 0
+		self.first = None			# arrival of the first request and completion of the last one
+		self.last = None
+
+	def record(self, latency, rows):
+		now = time.perf_counter()
+		if self.first is None:
+			self.first = now - latency
+		self.last = now
+		self.latencies.append(latency)
+		self.requests += 1
+		self.rows += rows
+
+	def report(self):
+		elapsed = max((self.last or 0) - (self.first or 0), 1e-9)		# throughput while serving, idle time before excluded
+		latencies = np.array(self.latencies) * 1e3
+		report = dict(requests=self.requests, rows=self.rows, seconds=round(elapsed, 3),
+			requests_per_s=round(self.requests / elapsed, 1), rows_per_s=round(self.rows / elapsed, 1))
+		if len(latencies):
+			report.update(p50_ms=round(float(np.percentile(latencies, 50)), 3), p99_ms=round(float(np.percentile(latencies, 99)), 3), mean_ms=round(float(latencies.mean()), 3))
+		if self.batches:
+			report.update(batches=len(self.batches), mean_batch_rows=round(float(np.mean(self.batches)), 1))
+		return report
+
+
+class MicroBatcher(object):
+	'''Queue of prediction requests for one model, predicted together in batches of up to max_batch rows'''
+	def __init__(self, model, max_batch, max_delay, stats):
+		self.estimator = model['estimator']
+		self.n_features = len(model['features'])
+		self.pca = model.get('pca')			# models fitted on principal components project the raw rows first
+		self.norms = np.asarray(model['norms'], dtype=np.float64)
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.stats = stats
+		self.queue = asyncio.Queue()
+
+	async def predict(self, rows):
+		'''Waiting for the predictions of one request'''
+		future = asyncio.get_running_loop().create_future()
+		self.queue.put_nowait((rows, future))
+		return await future
+
+	def predict_batch(self, X):
+		'''Normalizing the raw rows like analyse.py did for training and predicting them'''
+		if self.pca is not None:
+			X = self.pca.transform(X)
+		return self.estimator.predict(X / self.norms)
+
+	async def run(self):
+		'''Collecting requests until the batch is full or max_delay has passed, then predicting them at once'''
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = [await self.queue.get()]
+			n = len(batch[0][0])
+			deadline = loop.time() + self.max_delay
+			while n < self.max_batch:
+				if self.queue.empty():
+					timeout = deadline - loop.time()
+					if timeout <= 0:
+						break
+					try:
+						item = await asyncio.wait_for(self.queue.get(), timeout)
+					except asyncio.TimeoutError:
+						break
+				else:
+					item = self.queue.get_nowait()
+				batch.append(item)
+				n += len(item[0])
+
+			X = np.concatenate([rows for rows, _ in batch])
+			try:
+				y = await loop.run_in_executor(None, self.predict_batch, X)		# the loop keeps accepting requests meanwhile
+			except Exception:
+				await self.predict_each(batch)
+				continue
+			self.stats.batches.append(n)
+			start = 0
+			for rows, future in batch:
+				if not future.done():
+					future.set_result(y[start:start + len(rows)])
+				start += len(rows)
+
+	async def predict_each(self, batch):
+		'''Predicting the requests of a failed batch one by one, so an error only reaches its own request'''
+		loop = asyncio.get_running_loop()
+		for rows, future in batch:
+			try:
+				y = await loop.run_in_executor(None, self.predict_batch, rows)
+			except Exception as e:
+				if not future.done():
+					future.set_exception(e)
+				continue
+			self.stats.batches.append(len(rows))
+			if not future.done():
+				future.set_result(y)
+
+
+class Server(object):
+	'''HTTP/1.1 keep-alive endpoint dispatching requests to one MicroBatcher per model'''
+	def __init__(self, bundle, max_batch, max_delay):
+		self.bundle = bundle
+		self.target_names = bundle['target_names']
+		self.stats = LatencyStats()
+		self.batchers = {key: MicroBatcher(model, max_batch, max_delay, self.stats) for key, model in bundle['models'].items()}
+
+	async def route(self, method, path, body):
+		'''Status and JSON payload of one request'''
+		if path == '/models':
+			return 200, dict(dataset=self.bundle['dataset'], target_names=self.target_names, models={key: dict(features=model['features'], cv_mean=model['cv_mean']) for key, model in self.bundle['models'].items()})
+		if path == '/stats':
+			return 200, self.stats.report()
+		if not path.startswith('/predict/'):
+			return 404, dict(error='unknown path ' + path)
+		key = path[len('/predict/'):]
+		if key not in self.batchers:
+			return 404, dict(error='unknown model ' + key, models=sorted(self.batchers))
+		if method != 'POST':
+			return 405, dict(error='use POST')
+
+		start = time.perf_counter()
+		batcher = self.batchers[key]
+		try:
+			rows = np.asarray(json.loads(body)['rows'], dtype=np.float64)
+		except (ValueError, KeyError, TypeError) as e:
+			return 400, dict(error='expected {"rows": [[...], ...]}: ' + str(e))
+		if rows.ndim != 2 or rows.shape[1] != batcher.n_features:
+			return 400, dict(error='expected rows of {0} values: {1}'.format(batcher.n_features, ', '.join(self.bundle['models'][key]['features'])))
+		if not np.isfinite(rows).all():			# json accepts NaN and Infinity, the models don't
+			return 400, dict(error='rows must hold finite numbers only')
+		y = await batcher.predict(rows)
+		self.stats.record(time.perf_counter() - start, len(rows))
+		return 200, dict(predictions=[self.target_names[c] for c in y.tolist()], classes=y.tolist())
+
+	async def handle(self, reader, writer):
+		'''Serving the requests of one connection until the client closes it'''
+		try:
+			while True:
+				line = await reader.readline()
+				if not line.strip():
+					break
+				method, path = line.decode('latin-1').split()[:2]
+				headers = dict()
+				while True:
+					header = await reader.readline()
+					if header in (b'\r\n', b'\n', b''):
+						break
+					name, _, value = header.decode('latin-1').partition(':')
+					headers[name.strip().lower()] = value.strip()
+				body = await reader.readexactly(int(headers.get('content-length', 0)))
+				try:
+					status, payload = await self.route(method, path, body)
+				except Exception as e:
+					status, payload = 500, dict(error=repr(e))
+				data = json.dumps(payload).encode()
+				writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n'.format(status, STATUS[status], len(data)).encode() + data)
+				await writer.drain()
+				if headers.get('connection', '').lower() == 'close':
+					break
+		except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	async def report(self, every):
+		'''Printing the statistics periodically while there is traffic'''
+		last = 0
+		while True:
+			await asyncio.sleep(every)
+			if self.stats.requests != last:
+				last = self.stats.requests
+				print(' ' + json.dumps(self.stats.report()))
+
+
+async def serve(args):
+	'''Running the batchers and the HTTP listener until interrupted'''
+	bundle = load_models(args.models)
+	server = Server(bundle, max(1, args.max_batch), args.max_delay / 1e3)
+	tasks = [asyncio.create_task(batcher.run()) for batcher in server.batchers.values()]
+	if args.report_every > 0:
+		tasks.append(asyncio.create_task(server.report(args.report_every)))
+	listener = await asyncio.start_server(server.handle, args.host, args.port)
+	print('Serving {0} models of {1} on http://{2}:{3}/ (max batch {4} rows, {5} ms)'.format(len(server.batchers), bundle['dataset'], args.host, args.port, args.max_batch, args.max_delay))
+	for key, model in sorted(bundle['models'].items()):
+		print('  /predict/{0}: {1}'.format(key, ', '.join(model['features'])))
+	try:
+		async with listener:
+			await listener.serve_forever()
+	finally:
+		for task in tasks:
+			task.cancel()
+		print('\n Final statistics: ' + json.dumps(server.stats.report()))
+
+
+def main(argv=None):
+	'''Serving until Ctrl-C'''
+	args = parser_assign(argv)
+	try:
+		asyncio.run(serve(args))
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main()